@@ -1,8 +1,18 @@
 import streamlit as st
-import os, json, hashlib, datetime, urllib.parse, re, base64, io
+import os, json, hashlib, datetime, urllib.parse, re, zlib
+import sqlite3, threading, time, uuid, tempfile, functools, inspect, queue, asyncio, contextlib
+import hmac, base64, secrets, atexit
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeout
+from collections import OrderedDict, deque
+from typing import NamedTuple, Optional
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from groq import Groq
+import httpx
 from dotenv import load_dotenv
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from gtts import gTTS
 
 load_dotenv()
@@ -11,42 +21,625 @@ load_dotenv()
 USER_DB   = "users.json"
 MEMORY_DB = "memory.json"
 
-def load_users():
-    if os.path.exists(USER_DB):
+def read_json(path):
+    """Missing or empty file → {}. A corrupt file raises instead of reading as empty."""
+    try:
+        with open(path, "r") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return {}
+    return json.loads(raw) if raw.strip() else {}
+
+def write_json_atomic(path, data):
+    """Write to a temp file in the same directory, fsync, then rename over `path`."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+# ─── CONVERSATION STORE ───────────────────────────────────────────────────────
+# Chat history lives in SQLite (WAL mode): each turn appends only its new rows
+# and a login reads only that user's tail. memory.json is imported once.
+# Writes are write-behind: save_memory gives new messages their ids and queues
+# them, and a flusher commits everything queued within MEMORY_FLUSH_DELAY in one
+# transaction. Logout, a user's next tail() and interpreter exit flush first.
+# messages_fts (FTS5, external content) is kept in sync by triggers, so every
+# insert, compaction and clear updates the search index in the same commit.
+# A reply's media (image grid, YouTube cards, weather card) is stored on its row
+# as zlib'd compact JSON, so reloaded history renders without refetching.
+CONV_DB            = "iris.db"
+MEMORY_KEEP        = 80
+MEMORY_FLUSH_DELAY = float(os.getenv("IRIS_MEMORY_FLUSH_DELAY", "0.25"))  # seconds
+
+def pack_media(media):
+    return zlib.compress(json.dumps(media, separators=(",", ":")).encode()) if media else None
+
+def unpack_media(blob):
+    return json.loads(zlib.decompress(blob)) if blob else None
+
+FTS_STOP = frozenset("""a an and are as at be but by can do does for from how i in is it me
+my of on or so that the this to was we what when where which who why will with you your""".split())
+
+def fts_query(text, any_term=False, prefix=False):
+    """An FTS5 MATCH expression for free text: quoted terms, ANDed (or ORed
+    without stopwords); with prefix the last term also matches as a prefix."""
+    words = re.findall(r"\w+", text.lower())
+    if any_term:
+        words = [w for w in words if w not in FTS_STOP and len(w) > 1]
+    terms = [f'"{w}"' for w in words]
+    if prefix and terms:
+        terms[-1] += "*"
+    return (" OR " if any_term else " ").join(terms)
+
+def sqlite_conn(local, path):
+    """One connection per thread; WAL lets readers run alongside the writer."""
+    c = getattr(local, "conn", None)
+    if c is None:
+        c = sqlite3.connect(path, timeout=10)
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        local.conn = c
+    return c
+
+class ConversationStore:
+    """Append-only per-user message log with write-behind and background compaction."""
+    def __init__(self, path, keep=MEMORY_KEEP, compact_every=60, flush_delay=MEMORY_FLUSH_DELAY):
+        self.path, self.keep, self.flush_delay = path, keep, flush_delay
+        self._local = threading.local()
+        self._dirty, self._dirty_lock = set(), threading.Lock()
+        self._pending, self._cv = {}, threading.Condition()  # email -> {"clear", "rows"}
+        self._write_lock = threading.Lock()
+        self._inflight = set()  # emails in the batch flush() is committing
+        self._clears = {}  # email -> clear() calls so far, to spot stale summaries
+        self._flush_ms, self._flushes, self._errors = deque(maxlen=200), 0, 0
+        c = self._conn()
+        with c:
+            c.execute("""CREATE TABLE IF NOT EXISTS messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL,
+                id TEXT NOT NULL UNIQUE, role TEXT NOT NULL, content TEXT NOT NULL,
+                ts REAL NOT NULL, media BLOB)""")
+            if "media" not in {r[1] for r in c.execute("PRAGMA table_info(messages)")}:
+                c.execute("ALTER TABLE messages ADD COLUMN media BLOB")  # pre-media iris.db
+            c.execute("CREATE INDEX IF NOT EXISTS messages_email_seq ON messages(email, seq)")
+            c.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            c.execute("""CREATE TABLE IF NOT EXISTS summaries (
+                email TEXT PRIMARY KEY, summary TEXT NOT NULL, upto TEXT NOT NULL,
+                ts REAL NOT NULL)""")
+        self.fts = self._create_fts(c)
+        self._import_legacy(MEMORY_DB)
+        threading.Thread(target=self._compactor, args=(compact_every,),
+                         name="iris-compactor", daemon=True).start()
+        threading.Thread(target=self._flusher, name="iris-memory-flush", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _conn(self):
+        return sqlite_conn(self._local, self.path)
+
+    def _create_fts(self, c):
+        """Create the search index (backfilled once); False if SQLite lacks FTS5."""
+        if c.execute("SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone():
+            return True
         try:
-            with open(USER_DB, "r") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            pass # Return empty if corrupted or empty
-    return {}
+            with c:
+                c.execute("""CREATE VIRTUAL TABLE messages_fts USING fts5(
+                    content, content='messages', content_rowid='seq')""")
+                c.execute("""CREATE TRIGGER messages_fts_ai AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts(rowid, content) VALUES (new.seq, new.content); END""")
+                c.execute("""CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts(messages_fts, rowid, content)
+                    VALUES ('delete', old.seq, old.content); END""")
+                c.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+            return True
+        except sqlite3.OperationalError:
+            return False  # no FTS5 in this build: search() falls back to LIKE
+
+    def _import_legacy(self, path):
+        c = self._conn()
+        if c.execute("SELECT 1 FROM meta WHERE key='legacy_memory'").fetchone():
+            return
+        try:
+            data = read_json(path)
+        except ValueError:
+            data = {} # unreadable legacy file: start empty, leave it on disk
+        with c:
+            for email, msgs in data.items():
+                self._insert(c, email, msgs[-self.keep:])
+            c.execute("INSERT INTO meta VALUES ('legacy_memory', ?)", (str(time.time()),))
+
+    def _insert(self, c, email, msgs):
+        now = time.time()
+        for m in msgs:
+            m.setdefault("id", uuid.uuid4().hex)
+        c.executemany("INSERT INTO messages (email, id, role, content, ts, media) VALUES (?,?,?,?,?,?)",
+                      [(email, m["id"], m["role"], m["content"], now, pack_media(m.get("media")))
+                       for m in msgs])
+
+    def _settle(self, email):
+        """Flush if `email` has writes queued or mid-commit, so a read sees them."""
+        with self._cv:
+            busy = email in self._pending or email in self._inflight
+        if busy:
+            self.flush()  # waits on _write_lock for a commit already under way
+
+    def tail(self, email, n=None):
+        self._settle(email)
+        rows = self._conn().execute(
+            "SELECT id, role, content, media FROM messages WHERE email=? ORDER BY seq DESC LIMIT ?",
+            (email, n or self.keep)).fetchall()
+        msgs = []
+        for i, r, t, media in reversed(rows):
+            msgs.append({"id": i, "role": r, "content": t})
+            if media:
+                msgs[-1]["media"] = unpack_media(media)
+        return msgs
 
-def save_users(u):
-    with open(USER_DB, "w") as f:
-        json.dump(u, f)
+    def append(self, email, msgs):
+        """Queue the messages not stored yet (no "id"); they get their ids now."""
+        new = [m for m in msgs if "id" not in m]
+        if not new:
+            return
+        for m in new:
+            m["id"] = uuid.uuid4().hex
+        with self._cv:
+            self._pending.setdefault(email, {"clear": False, "rows": []})["rows"] += map(dict, new)
+            self._cv.notify()
+
+    def clear(self, email):
+        """Queue deleting the user's history and summary; unflushed rows are dropped."""
+        with self._cv:
+            self._pending[email] = {"clear": True, "rows": []}
+            self._clears[email] = self._clears.get(email, 0) + 1
+            self._cv.notify()
+
+    def generation(self, email):
+        """Changes on every clear(); pass it to set_summary from background jobs."""
+        with self._cv:
+            return self._clears.get(email, 0)
+
+    def summary(self, email):
+        """(rolling summary, id of the last message folded into it) or None."""
+        if self._pending.get(email, {}).get("clear"):
+            return None
+        return self._conn().execute(
+            "SELECT summary, upto FROM summaries WHERE email=?", (email,)).fetchone()
+
+    def search(self, email, query, limit=8, any_term=False, prefix=False, exclude=(), fresh=True):
+        """The user's stored messages matching `query`, best first, as dicts with
+        id, seq, role, content, snippet and ts. The snippet marks matched terms with
+        \x02…\x03 rather than markdown, which the content may already contain.
+        `exclude` skips message ids; with fresh, queued writes are flushed first
+        so the newest turns are found."""
+        if fresh:
+            self._settle(email)
+        skip = f"AND m.id NOT IN ({','.join('?' * len(exclude))})" if exclude else ""
+        if self.fts:
+            match = fts_query(query, any_term, prefix)
+            if not match:
+                return []
+            sql = f"""SELECT m.id, m.seq, m.role, m.content, m.ts,
+                          snippet(messages_fts, 0, char(2), char(3), '…', 12)
+                      FROM messages_fts JOIN messages m ON m.seq = messages_fts.rowid
+                      WHERE messages_fts MATCH ? AND m.email = ? {skip}
+                      ORDER BY rank LIMIT ?"""
+            args = [match, email]
+        else:
+            words = re.findall(r"\w+", query.lower())
+            if not words:
+                return []
+            like = " AND ".join(["m.content LIKE ?"] * len(words))
+            sql = f"""SELECT m.id, m.seq, m.role, m.content, m.ts, substr(m.content, 1, 120)
+                      FROM messages m WHERE {like} AND m.email = ? {skip}
+                      ORDER BY m.seq DESC LIMIT ?"""
+            args = [f"%{w}%" for w in words] + [email]
+        try:
+            rows = self._conn().execute(sql, args + list(exclude) + [limit]).fetchall()
+        except sqlite3.OperationalError:
+            return []  # a query FTS5 can't parse
+        return [{"id": i, "seq": q, "role": r, "content": t, "ts": ts, "snippet": sn}
+                for i, q, r, t, ts, sn in rows]
+
+    def flush(self):
+        """Write everything queued so far; returns when it is committed."""
+        with self._write_lock:
+            with self._cv:
+                batch, self._pending = self._pending, {}
+                self._inflight = set(batch)
+            if not batch:
+                return
+            t0 = time.perf_counter()
+            c = self._conn()
+            try:
+                with c:
+                    for email, job in batch.items():
+                        if job["clear"]:
+                            c.execute("DELETE FROM messages WHERE email=?", (email,))
+                            c.execute("DELETE FROM summaries WHERE email=?", (email,))
+                        self._insert(c, email, job["rows"])
+            except sqlite3.Error:
+                self._errors += 1
+                with self._cv:  # put it back in front of anything queued since
+                    for email, job in self._pending.items():
+                        if job["clear"]:
+                            batch[email] = job
+                        else:
+                            batch.setdefault(email, {"clear": False, "rows": []})["rows"] += job["rows"]
+                    self._pending = batch
+                    self._inflight = set()
+                raise
+            self._flush_ms.append((time.perf_counter() - t0) * 1000)
+            self._flushes += 1
+            with self._cv:
+                self._inflight = set()
+        with self._dirty_lock:
+            self._dirty.update(batch)
+
+    def _flusher(self):
+        while True:
+            with self._cv:
+                while not self._pending:
+                    self._cv.wait()
+            time.sleep(self.flush_delay)  # let more turns coalesce into this commit
+            try:
+                self.flush()
+            except sqlite3.Error:
+                time.sleep(1)  # retried on the next pass
+
+    def stats(self):
+        """Write-behind queue depth and flush latency."""
+        def pct(xs, q):
+            xs = sorted(xs)
+            return round(xs[min(len(xs) - 1, int(q * len(xs)))], 2) if xs else None
+        with self._cv:
+            rows = sum(len(j["rows"]) for j in self._pending.values())
+            users = len(self._pending)
+        return {"queued_rows": rows, "queued_users": users, "flushes": self._flushes,
+                "errors": self._errors, "flush_ms_p50": pct(self._flush_ms, .5),
+                "flush_ms_p95": pct(self._flush_ms, .95)}
+
+    def set_summary(self, email, text, upto, generation=None):
+        """Store the summary; skipped (False) if the history was cleared since
+        `generation` was read. Holding _write_lock means a clear queued after the
+        check is committed after this write, and deletes it."""
+        with self._write_lock:
+            if generation is not None and generation != self.generation(email):
+                return False
+            c = self._conn()
+            with c:
+                c.execute("INSERT OR REPLACE INTO summaries VALUES (?,?,?,?)",
+                          (email, text, upto, time.time()))
+        return True
+
+    def compact(self):
+        """Drop rows beyond each touched user's last `keep` and checkpoint the WAL."""
+        with self._dirty_lock:
+            emails, self._dirty = self._dirty, set()
+        c = self._conn()
+        with c:
+            for email in emails:
+                c.execute("""DELETE FROM messages WHERE email=? AND seq <= (
+                    SELECT seq FROM messages WHERE email=? ORDER BY seq DESC LIMIT 1 OFFSET ?)""",
+                          (email, email, self.keep))
+        c.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def _compactor(self, every):
+        while True:
+            time.sleep(every)
+            try:
+                self.compact()
+            except sqlite3.Error:
+                pass # retried on the next tick
 
-def hash_pw(p):
-    return hashlib.sha256(p.encode()).hexdigest()
+@st.cache_resource
+def get_store():
+    return ConversationStore(CONV_DB)
 
 def load_memory(email):
-    if os.path.exists(MEMORY_DB):
-        try:
-            with open(MEMORY_DB, "r") as f:
-                return json.load(f).get(email, [])
-        except json.JSONDecodeError:
-            pass # Return empty list if corrupted or empty
-    return []
+    return get_store().tail(email)
 
 def save_memory(email, msgs):
-    data = {}
-    if os.path.exists(MEMORY_DB):
+    if not msgs:
+        get_store().clear(email)
+    else:
+        get_store().append(email, msgs)
+
+# ─── USER STORE ───────────────────────────────────────────────────────────────
+# Accounts are rows in iris.db keyed by email: login is one primary-key lookup
+# and signup one INSERT, with uniqueness enforced by SQLite across sessions and
+# processes. users.json is imported once; import_json/export_json move accounts
+# in and out in that same {email: hash} shape. Until users.json has imported,
+# the store refuses to open and login and signup report it unreadable.
+class UserStore:
+    def __init__(self, path):
+        self.path, self._local = path, threading.local()
+        c = self._conn()
+        with c:
+            c.execute("""CREATE TABLE IF NOT EXISTS users (
+                email TEXT PRIMARY KEY, pw TEXT NOT NULL, created REAL NOT NULL,
+                session_gen INTEGER NOT NULL DEFAULT 0)""")
+            if "session_gen" not in {r[1] for r in c.execute("PRAGMA table_info(users)")}:
+                c.execute("ALTER TABLE users ADD COLUMN session_gen INTEGER NOT NULL DEFAULT 0")
+            c.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if not c.execute("SELECT 1 FROM meta WHERE key='legacy_users'").fetchone():
+            # a corrupt users.json raises and stays unimported, so no one can sign
+            # up as an account it holds (and inherit its imported history)
+            self.import_json(USER_DB)
+            with c:
+                c.execute("INSERT OR IGNORE INTO meta VALUES ('legacy_users', ?)", (str(time.time()),))
+
+    def _conn(self):
+        return sqlite_conn(self._local, self.path)
+
+    def get(self, email):
+        """The stored password hash, or None."""
+        row = self._conn().execute("SELECT pw FROM users WHERE email=?", (email,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, email, pw_hash):
+        """Create an account; False if the email is already taken."""
+        c = self._conn()
         try:
-            with open(MEMORY_DB, "r") as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            pass
-    data[email] = msgs[-80:]
-    with open(MEMORY_DB, "w") as f:
-        json.dump(data, f)
+            with c:
+                c.execute("INSERT INTO users (email, pw, created) VALUES (?,?,?)",
+                          (email, pw_hash, time.time()))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def session_gen(self, email):
+        """Generation session tokens must carry, or None for an unknown user."""
+        row = self._conn().execute("SELECT session_gen FROM users WHERE email=?", (email,)).fetchone()
+        return row[0] if row else None
+
+    def revoke_sessions(self, email):
+        c = self._conn()
+        with c:
+            c.execute("UPDATE users SET session_gen = session_gen + 1 WHERE email=?", (email,))
+
+    def set(self, email, pw_hash):
+        c = self._conn()
+        with c:
+            c.execute("UPDATE users SET pw=? WHERE email=?", (pw_hash, email))
+
+    def import_json(self, path, replace=False):
+        """Load a users.json ({email: hash}); returns the number of rows written.
+        Existing accounts are kept unless `replace`."""
+        data = read_json(path)
+        # a replaced hash also revokes that user's session tokens
+        conflict = ("DO UPDATE SET pw=excluded.pw, session_gen=session_gen+1" if replace
+                    else "DO NOTHING")
+        c = self._conn()
+        with c:
+            n = c.total_changes
+            c.executemany(f"""INSERT INTO users (email, pw, created) VALUES (?,?,?)
+                              ON CONFLICT(email) {conflict}""",
+                          [(e, h, time.time()) for e, h in data.items()])
+            return c.total_changes - n
+
+    def export_json(self, path):
+        """Write every account to `path` as users.json; returns the count."""
+        rows = self._conn().execute("SELECT email, pw FROM users ORDER BY email").fetchall()
+        write_json_atomic(path, dict(rows))
+        return len(rows)
+
+@st.cache_resource
+def get_users():
+    return UserStore(CONV_DB)
+
+# ─── AUTH ─────────────────────────────────────────────────────────────────────
+# Passwords are salted scrypt ("scrypt$n$r$p$salt$hash"), computed on a small
+# pool so a burst of logins can't pile up 16 MB hashes on the script threads.
+# Old unsalted SHA-256 entries still verify and are rehashed on that login.
+# A signed session token in the URL (?session=) lets a reconnect or reload
+# skip the password check entirely. Tokens carry the user's session generation;
+# logout bumps it, which revokes every token issued before.
+PW_SCRYPT   = {"n": 1 << 14, "r": 8, "p": 1}
+PW_WORKERS  = 2
+SESSION_TTL = int(os.getenv("IRIS_SESSION_TTL", str(7 * 24 * 3600)))
+
+def hash_pw(p, salt=None):
+    salt = salt or os.urandom(16)
+    d = hashlib.scrypt(p.encode(), salt=salt, **PW_SCRYPT, maxmem=64 << 20)
+    return "scrypt${n}${r}${p}$".format(**PW_SCRYPT) + f"{salt.hex()}${d.hex()}"
+
+def verify_pw(p, stored):
+    """(matches, needs rehash) for a stored hash in either format."""
+    if not stored.startswith("scrypt$"):  # legacy unsalted sha256 hex
+        return hmac.compare_digest(hashlib.sha256(p.encode()).hexdigest(), stored), True
+    _, n, r, par, salt, want = stored.split("$")
+    params = {"n": int(n), "r": int(r), "p": int(par)}
+    d = hashlib.scrypt(p.encode(), salt=bytes.fromhex(salt), **params, maxmem=64 << 20)
+    return hmac.compare_digest(d.hex(), want), params != PW_SCRYPT
+
+@st.cache_resource
+def pw_pool():
+    return ThreadPoolExecutor(max_workers=PW_WORKERS, thread_name_prefix="iris-pw")
+
+@st.cache_resource
+def pw_decoy():
+    # verified against for unknown emails, so they cost as much as a wrong password
+    return hash_pw(secrets.token_hex(8))
+
+def authenticate(email, pw):
+    """True if `pw` is `email`'s password. Legacy hashes are upgraded in the background."""
+    stored = get_users().get(email)
+    ok, stale = pw_pool().submit(verify_pw, pw, stored or pw_decoy()).result()
+    if ok and stored and stale:
+        pw_pool().submit(lambda: get_users().set(email, hash_pw(pw)))
+    return ok and stored is not None
+
+def create_user(email, pw):
+    return get_users().add(email, pw_pool().submit(hash_pw, pw).result())
+
+@st.cache_resource
+def session_secret():
+    """IRIS_SESSION_SECRET, else a random key generated once and kept in iris.db."""
+    env = os.getenv("IRIS_SESSION_SECRET")
+    if env:
+        return env.encode()
+    c = get_store()._conn()
+    with c:
+        c.execute("INSERT OR IGNORE INTO meta VALUES ('session_secret', ?)", (secrets.token_hex(32),))
+    return c.execute("SELECT value FROM meta WHERE key='session_secret'").fetchone()[0].encode()
+
+def _session_sig(payload):
+    return hmac.new(session_secret(), payload.encode(), hashlib.sha256).hexdigest()[:32].encode()
+
+def sign_session(email, ttl=SESSION_TTL):
+    payload = f"{email}|{int(time.time() + ttl)}|{get_users().session_gen(email)}"
+    return base64.urlsafe_b64encode(f"{payload}|{_session_sig(payload).decode()}".encode()).decode()
+
+def check_session(token):
+    """The email a session token was issued for, or None if it is bad, expired
+    or revoked by a later logout."""
+    try:
+        email, exp, gen, sig = base64.urlsafe_b64decode(token.encode()).decode().rsplit("|", 3)
+        if not hmac.compare_digest(sig.encode(), _session_sig(f"{email}|{exp}|{gen}")):
+            return None
+        exp, gen = int(exp), int(gen)
+    except (ValueError, UnicodeError):
+        return None
+    if exp < time.time() or gen != get_users().session_gen(email):
+        return None
+    return email
+
+# ─── TRACING ──────────────────────────────────────────────────────────────────
+# Each chat turn records a Trace: timed spans for the intent scan, every tool,
+# cache lookup, upstream HTTP call, LLM stream (with TTFT), gTTS and the memory
+# write. Pool threads join the turn's trace through submit() and run_tool.
+# When configured, finished turns are appended to IRIS_TRACE_FILE as JSONL (off
+# by default: the file is never rotated), sent to OpenTelemetry
+# (OTEL_EXPORTER_OTLP_ENDPOINT) and exposed to Prometheus (IRIS_PROMETHEUS_PORT).
+# ?debug=1 shows the breakdown under the chat.
+TRACE_FILE      = os.getenv("IRIS_TRACE_FILE", "")
+TRACE_KEEP      = 20  # turns kept per session for the debug panel
+PROMETHEUS_PORT = int(os.getenv("IRIS_PROMETHEUS_PORT", "0"))
+
+@st.cache_resource
+def trace_local():
+    # process-wide: cached objects (ResponseCache…) keep the globals of the run
+    # that created them, so a per-run threading.local would split the spans
+    return threading.local()
+
+_trace = trace_local()
+
+class Trace:
+    def __init__(self, name, **attrs):
+        self.id, self.name, self.attrs = uuid.uuid4().hex, name, attrs
+        self.t0, self.wall, self.ms = time.perf_counter(), time.time(), None
+        self.spans, self._lock = [], threading.Lock()
+
+    def add(self, name, start, end, attrs):
+        with self._lock:
+            self.spans.append({"name": name, "start_ms": round((start - self.t0) * 1000, 1),
+                               "ms": round((end - start) * 1000, 1),
+                               "thread": threading.current_thread().name, **attrs})
+
+    def finish(self):
+        """Close the turn and export it in the background; returns the record."""
+        self.ms = round((time.perf_counter() - self.t0) * 1000, 1)
+        rec = self.record()
+        submit(trace_sink().export, rec)
+        return rec
+
+    def record(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda x: x["start_ms"])
+        return {"trace": self.id, "name": self.name, "ts": self.wall, "ms": self.ms,
+                **self.attrs, "spans": spans}
+
+def current_trace():
+    return getattr(_trace, "current", None)
+
+def bind_trace(trace):
+    """Make `trace` the one spans on this thread are recorded into."""
+    _trace.current, _trace.stack = trace, []
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Time a stage of the current turn; the yielded dict takes extra attributes."""
+    tr = current_trace()
+    if tr is None:
+        yield attrs
+        return
+    stack = _trace.stack
+    stack.append(attrs)
+    t0 = time.perf_counter()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i] is attrs:
+                del stack[i]
+                break
+        tr.add(name, t0, time.perf_counter(), attrs)
+
+def note(**attrs):
+    """Add attributes (cache=hit, bytes=…) to the innermost open span on this thread."""
+    stack = getattr(_trace, "stack", None)
+    if stack and current_trace():
+        stack[-1].update(attrs)
+
+class TraceSink:
+    """JSONL file plus the optional OpenTelemetry and Prometheus exporters."""
+    def __init__(self):
+        self._lock, self.otel, self.prom = threading.Lock(), None, None
+        if os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+            try:
+                from opentelemetry.sdk.resources import Resource
+                from opentelemetry.sdk.trace import TracerProvider
+                from opentelemetry.sdk.trace.export import BatchSpanProcessor
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+                provider = TracerProvider(resource=Resource.create({"service.name": "iris"}))
+                provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+                self.otel = provider.get_tracer("iris")
+            except ImportError:
+                pass
+        if PROMETHEUS_PORT:
+            try:
+                import prometheus_client as prom
+                self.prom = prom.Histogram("iris_stage_seconds", "Chat turn stage latency", ["stage"])
+                prom.start_http_server(PROMETHEUS_PORT)
+            except ImportError:
+                pass
+
+    def export(self, rec):
+        if TRACE_FILE:
+            line = json.dumps(rec, ensure_ascii=False, default=str)
+            with self._lock, open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        if self.prom:
+            self.prom.labels(rec["name"]).observe(rec["ms"] / 1000)
+            for sp in rec["spans"]:
+                self.prom.labels(sp["name"]).observe(sp["ms"] / 1000)
+        if self.otel:
+            self._otel(rec)
+
+    def _otel(self, rec):
+        from opentelemetry import trace as ot
+        ns = lambda ms: int(rec["ts"] * 1e9 + ms * 1e6)
+        scalar = lambda d: {k: v for k, v in d.items() if isinstance(v, (str, int, float, bool))}
+        root = self.otel.start_span(rec["name"], start_time=ns(0),
+                                    attributes=scalar({k: v for k, v in rec.items() if k != "spans"}))
+        ctx = ot.set_span_in_context(root)
+        for sp in rec["spans"]:
+            self.otel.start_span(sp["name"], context=ctx, start_time=ns(sp["start_ms"]),
+                                 attributes=scalar(sp)).end(end_time=ns(sp["start_ms"] + sp["ms"]))
+        root.end(end_time=ns(rec["ms"]))
+
+@st.cache_resource
+def trace_sink():
+    return TraceSink()
 
 # ─── PAGE CONFIG ──────────────────────────────────────────────────────────────
 st.set_page_config(page_title="IRIS AI", page_icon="◈", layout="wide",
@@ -56,7 +649,8 @@ st.set_page_config(page_title="IRIS AI", page_icon="◈", layout="wide",
 for k, v in {
     "authenticated": False, "user_email": None, "messages": [],
     "theme": "black", "tts_lang": "en", "active_module": "chat",
-    "tts_enabled": True, "chat_media": {}
+    "tts_enabled": True, "chat_html": {}, "chat_window": None,
+    "traces": []
 }.items():
     if k not in st.session_state:
         st.session_state[k] = v
@@ -98,383 +692,242 @@ T = THEMES[st.session_state.theme]
 
 # ─── GTTS — library-based TTS ─────────────────────────────────────────────────
 def speak(text: str, lang: str = "en"):
-    """gTTS generates MP3, embedded as autoplay <audio> in browser."""
+    """gTTS MP3 (cached) played through st.audio, which serves the bytes from
+    Streamlit's media endpoint instead of inlining them into the page."""
     if not text or not st.session_state.tts_enabled:
         return
     try:
-        clean = re.sub(r'[*_`#>\[\]|●▶◈◼🌤🔍🖼▶️💧💨👁📊☀️🌅🌇🧮💊📖🌐]', '', text)
-        clean = re.sub(r'\s+', ' ', clean).strip()[:700]
+        clean = tts_clean(text)[:700]
         if not clean:
             return
-        buf = io.BytesIO()
-        gTTS(text=clean, lang=lang, slow=False).write_to_fp(buf)
-        buf.seek(0)
-        b64 = base64.b64encode(buf.read()).decode()
-        st.markdown(
-            f'<audio autoplay controls style="width:100%;margin-top:8px;border-radius:8px;'
-            f'accent-color:{T["accent"]}">'
-            f'<source src="data:audio/mp3;base64,{b64}" type="audio/mp3">'
-            f'</audio>',
-            unsafe_allow_html=True
-        )
+        st.audio(tts_audio(clean, lang), format="audio/mpeg", autoplay=True)
     except Exception as e:
         st.caption(f"TTS: {e}")
 
+def tts_audio(clean, lang):
+    """MP3 bytes for already-cleaned text: memory LRU, then disk, then gTTS.
+    gTTS synthesises ~100-char parts; they are collected as each one arrives."""
+    def synth():
+        return b"".join(gTTS(text=clean, lang=lang, slow=False).stream()), None
+    key = "tts:" + hashlib.sha256(f"{lang}\0{clean}".encode()).hexdigest()
+    with span("tts", chars=len(clean)) as sp:
+        audio, _ = tts_cache().fetch(key, synth, TTS_CACHE_TTL)
+        sp["bytes"] = len(audio or b"")
+    return audio
+
+def tts_clean(text):
+    clean = re.sub(r'[*_`#>\[\]|●▶◈◼🌤🔍🖼▶️💧💨👁📊☀️🌅🌇🧮💊📖🌐]', '', text)
+    return re.sub(r'\s+', ' ', clean).strip()
+
+# ─── SPEECH PIPELINE ──────────────────────────────────────────────────────────
+# Streamed replies are spoken sentence by sentence while the LLM is still
+# generating: each sentence is synthesised on a small pool, added to the page
+# in order, and speech_player() plays the clips back to back.
+SPEECH_WORKERS   = 3
+SPEECH_MAX_CHARS = 3000
+SPEECH_MIN_CHARS = 12   # shorter fragments ride along with the next sentence
+SENTENCE_END     = re.compile(r'(?<=[.!?。！？।])\s+|\n+')
+
+@st.cache_resource
+def speech_pool():
+    return ThreadPoolExecutor(max_workers=SPEECH_WORKERS, thread_name_prefix="iris-tts")
+
+class SpeechPipeline:
+    def __init__(self, lang, container):
+        self.lang, self.box = lang, container
+        self._buf, self._carry, self._chars = "", "", 0
+        self._queue = []  # synthesis futures, in reading order
+        self.fed = False
+
+    def feed(self, delta):
+        self.fed = True
+        self._buf += delta
+        *sentences, self._buf = SENTENCE_END.split(self._buf)
+        for text in sentences:
+            self._say(text)
+        self.pump()
+
+    def _say(self, text, final=False):
+        clean = tts_clean(self._carry + " " + text)
+        if len(clean) < SPEECH_MIN_CHARS and not final:
+            self._carry = clean
+            return
+        self._carry = ""
+        clean = clean[:SPEECH_MAX_CHARS - self._chars]
+        if clean:
+            self._chars += len(clean)
+            self._queue.append(submit(tts_audio, clean, self.lang, pool=speech_pool()))
+
+    def pump(self):
+        """Add every synthesised clip at the head of the queue to the page."""
+        while self._queue and self._queue[0].done():
+            self._render(self._queue.pop(0))
+
+    def finish(self):
+        """Speak the trailing text and wait for the remaining clips, in order."""
+        self._say(self._buf, final=True)
+        self._buf = ""
+        while self._queue:
+            self._render(self._queue.pop(0))
+
+    def _render(self, fut):
+        try:
+            self.box.audio(fut.result(), format="audio/mpeg")
+        except Exception as e:
+            self.box.caption(f"TTS: {e}")
+
+def speech_player():
+    """Installs (once per page) a player that chains clips in iris_speech containers."""
+    import streamlit.components.v1 as components
+    components.html("""
+    <script>
+    const win = window.parent, doc = win.document;
+    if (!win.irisSpeech) {
+        const q = win.irisSpeech = {seen: new WeakSet(), list: [], current: null};
+        const next = () => {
+            if (q.current && doc.contains(q.current) && !q.current.ended) return;
+            q.current = q.list.shift() || null;
+            if (!q.current) return;
+            q.current.addEventListener('ended', next, {once: true});
+            q.current.play().catch(() => { q.current = null; next(); });
+        };
+        const scan = () => {
+            doc.querySelectorAll('[class*="st-key-iris_speech"] audio').forEach(a => {
+                if (!q.seen.has(a)) { q.seen.add(a); q.list.push(a); }
+            });
+            next();
+        };
+        new MutationObserver(scan).observe(doc.body, {childList: true, subtree: true});
+        scan();
+    }
+    </script>
+    """, height=0, width=0)
+
 # ─── CSS ──────────────────────────────────────────────────────────────────────
-st.markdown(f"""
-<style>
-@import url('https://fonts.googleapis.com/css2?family=Space+Mono:wght@400;700&family=Figtree:wght@300;400;500;600&family=Syne:wght@700;800&display=swap');
-
-*,*::before,*::after{{box-sizing:border-box;margin:0;padding:0;}}
-html,body,.stApp{{background:{T['bg']} !important;color:{T['text']};font-family:'Figtree',sans-serif;}}
-[data-testid="stHeader"], [data-testid="stToolbar"], [data-testid="stAppDeployButton"], #MainMenu, footer {{display:none !important;}}
-.block-container {{padding:0 !important;max-width:100% !important;}}
-[data-testid="stBottomBlockContainer"] {{background: transparent !important;}}
-
-/* BG atmosphere */
-.stApp::before{{content:'';position:fixed;inset:0;
-  background:radial-gradient(ellipse 70% 50% at 15% -10%,{T['ub']} 0%,transparent 55%),
-             radial-gradient(ellipse 50% 40% at 85% 110%,{T['ab']} 0%,transparent 55%),{T['bg']};
-  z-index:-2;pointer-events:none;}}
-.stApp::after{{content:'';position:fixed;inset:0;
-  background:repeating-linear-gradient(0deg,transparent,transparent 2px,rgba(0,0,0,0.01) 2px,rgba(0,0,0,0.01) 4px);
-  z-index:9999;pointer-events:none;}}
-
-/* ───────── SIDEBAR CONTAINER ───────── */
-section[data-testid="stSidebar"]{{
-    background:linear-gradient(180deg,{T['sb']} 0%,{T['bg2']} 100%) !important;
-    border-right:1px solid {T['border']} !important;
-    width:280px !important;
-    backdrop-filter:blur(14px);
-    box-shadow:8px 0 40px -20px {T['glow']};
-}}
-
-section[data-testid="stSidebar"]>div{{
-    padding:0 !important;
-    overflow-y:auto;
-    overflow-x:hidden;
-}}
-
-section[data-testid="stSidebar"] .stVerticalBlock{{
-    padding:28px 20px 100px !important;
-    gap:6px !important;
-}}
-
-/* ───────── LOGO AREA ───────── */
-.iris-logo{{
-    font-family:'Syne',sans-serif;
-    font-size:1.75rem;
-    font-weight:800;
-    letter-spacing:-1px;
-    color:{T['title']};
-    display:flex;
-    align-items:center;
-    gap:10px;
-    margin-bottom:4px;
-}}
-
-.iris-dot{{
-    width:8px;
-    height:8px;
-    border-radius:50%;
-    background:{T['accent']};
-    box-shadow:0 0 14px {T['accent']};
-    animation:blink 2.5s infinite ease-in-out;
-}}
-
-@keyframes blink{{
-    0%,100%{{opacity:1; transform:scale(1);}}
-    50%{{opacity:.4; transform:scale(.7);}}
-}}
-
-.iris-tag{{
-    font-family:'Space Mono',monospace;
-    font-size:.52rem;
-    color:{T['text_dim']};
-    letter-spacing:4px;
-    text-transform:uppercase;
-    margin-bottom:22px;
-    opacity:.8;
-}}
-
-/* ───────── USER CARD ───────── */
-.user-pill{{
-    background:linear-gradient(135deg,{T['ub']},{T['bg2']});
-    border:1px solid {T['ubr']};
-    border-radius:12px;
-    padding:10px 14px;
-    font-family:'Space Mono',monospace;
-    font-size:.6rem;
-    color:{T['accent']};
-    letter-spacing:.5px;
-    overflow:hidden;
-    text-overflow:ellipsis;
-    white-space:nowrap;
-    margin-bottom:22px;
-    transition:all .2s ease;
-}}
-
-.user-pill:hover{{
-    border-color:{T['accent']}55;
-    box-shadow:0 0 16px -6px {T['glow']};
-}}
-
-/* ───────── SECTION LABEL ───────── */
-.sec-label{{
-    font-family:'Space Mono',monospace;
-    font-size:.52rem;
-    color:{T['text_dimmer']};
-    letter-spacing:4px;
-    text-transform:uppercase;
-    padding:14px 0 6px;
-    margin-bottom:10px;
-    position:relative;
-}}
-
-.sec-label::after{{
-    content:'';
-    position:absolute;
-    left:0;
-    bottom:0;
-    width:28px;
-    height:2px;
-    background:{T['accent']};
-    border-radius:4px;
-    opacity:.7;
-}}
-
-/* ───────── STATUS BADGE ───────── */
-.status-ok{{
-    display:inline-flex;
-    align-items:center;
-    gap:8px;
-    font-family:'Space Mono',monospace;
-    font-size:.58rem;
-    color:{T['accent']};
-    letter-spacing:1px;
-    margin-bottom:14px;
-    padding:6px 10px;
-    background:{T['ub']};
-    border:1px solid {T['ubr']};
-    border-radius:20px;
-}}
-
-.status-ok::before{{
-    content:'';
-    width:6px;
-    height:6px;
-    border-radius:50%;
-    background:{T['accent']};
-    box-shadow:0 0 10px {T['accent']};
-    animation:blink 2.5s infinite;
-}}
-
-/* ───────── SIDEBAR BUTTON IMPROVEMENT ───────── */
-section[data-testid="stSidebar"] .stButton>button{{
-    background:transparent !important;
-    border:1px solid transparent !important;
-    border-radius:10px !important;
-    padding:8px 8px !important;
-    font-family:'Space Mono',monospace !important;
-    font-size:.56rem !important;
-    letter-spacing:1px !important;
-    color:{T['text_dim']} !important;
-    transition:all .18s ease !important;
-    white-space:nowrap !important;
-}}
-
-section[data-testid="stSidebar"] .stVerticalBlock > .element-container > .stButton>button{{
-    text-align:left !important;
-    justify-content:flex-start !important;
-    display:flex;
-    padding-left:12px !important;
-}}
-
-section[data-testid="stSidebar"] [data-testid="column"] .stButton>button{{
-    justify-content:center !important;
-    display:flex;
-    padding:8px 0 !important;
-}}
-
-section[data-testid="stSidebar"] .stButton>button:hover{{
-    background:{T['ub']} !important;
-    border-color:{T['border']} !important;
-    color:{T['accent']} !important;
-}}
-
-section[data-testid="stSidebar"] .stVerticalBlock > .element-container > .stButton>button:hover{{
-    transform:translateX(4px);
-}}
-
-/* ───────── SCROLLBAR ───────── */
-section[data-testid="stSidebar"]::-webkit-scrollbar{{
-    width:4px;
-}}
-section[data-testid="stSidebar"]::-webkit-scrollbar-thumb{{
-    background:{T['border']};
-    border-radius:4px;
-}}
-
-
-/* ── INPUTS ── */
-.stTextInput label,.stSelectbox label,.stSlider label,.stTextArea label{{
-  font-family:'Space Mono',monospace !important;font-size:.5rem !important;
-  letter-spacing:2px !important;color:{T['text_dim']} !important;text-transform:uppercase !important;}}
-.stTextInput>div>div>input,.stTextArea>div>div>textarea{{
-  background:{T['bg2']} !important;border:1px solid {T['border']} !important;
-  color:{T['text']} !important;border-radius:9px !important;
-  font-family:'Figtree',sans-serif !important;font-size:.85rem !important;
-  padding:10px 14px !important;transition:border-color .2s !important;}}
-.stTextInput>div>div>input:focus,.stTextArea>div>div>textarea:focus{{
-  border-color:{T['accent']}55 !important;box-shadow:0 0 0 3px {T['glow']} !important;outline:none !important;}}
-.stTextInput>div>div>input::placeholder{{color:{T['text_dimmer']} !important;
-  font-family:'Space Mono',monospace !important;font-size:.68rem !important;}}
-.stSelectbox>div>div{{background:{T['bg2']} !important;border:1px solid {T['border']} !important;
-  border-radius:9px !important;color:{T['text']} !important;}}
-.stSlider>div>div>div>div{{background:{T['accent']}33 !important;}}
-.stSlider>div>div>div>div>div{{background:{T['accent']} !important;box-shadow:0 0 8px {T['accent']} !important;}}
-
-/* ── BUTTONS ── */
-.stButton>button{{background:transparent !important;color:{T['text_dim']} !important;
-  border:1px solid {T['border']} !important;border-radius:8px !important;
-  font-family:'Space Mono',monospace !important;font-size:.48rem !important;
-  letter-spacing:1px !important;padding:4px 8px !important;width:100% !important;
-  transition:all .18s !important;margin-bottom:8px !important;text-transform:uppercase !important;}}
-.stButton>button:hover{{border-color:{T['accent']}44 !important;color:{T['accent']} !important;
-  background:{T['ub']} !important;}}
-.stForm [data-testid="stFormSubmitButton"] button{{background:{T['accent']} !important;
-  color:{T['bg']} !important;border:none !important;font-weight:700 !important;letter-spacing:2px !important;}}
-
-/* ── TABS ── */
-.stTabs [data-baseweb="tab-list"]{{background:transparent !important;gap:0 !important;
-  border-bottom:1px solid {T['border']} !important;margin-bottom:18px !important;}}
-.stTabs [data-baseweb="tab"]{{background:transparent !important;color:{T['text_dim']} !important;
-  font-family:'Space Mono',monospace !important;font-size:.52rem !important;
-  letter-spacing:3px !important;padding:10px 16px !important;border:none !important;
-  border-bottom:2px solid transparent !important;text-transform:uppercase !important;}}
-.stTabs [aria-selected="true"]{{color:{T['title']} !important;
-  border-bottom-color:{T['accent']} !important;background:transparent !important;}}
-.stTabs [data-baseweb="tab-highlight"],.stTabs [data-baseweb="tab-border"]{{display:none !important;}}
-
-/* ── CHAT MESSAGES ── */
-.stChatMessage{{background:{T['ab']} !important;border:1px solid {T['abr']} !important;
-  border-radius:14px !important;padding:16px 20px !important;margin-bottom:10px !important;
-  animation:msgIn .22s ease-out !important;}}
-.stChatMessage:has([data-testid="stChatMessageAvatarUser"]){{
-  background:{T['ub']} !important;border-color:{T['ubr']} !important;
-  flex-direction:row-reverse !important;text-align:right !important;
-  width:fit-content !important;max-width:80% !important;
-  margin-left:auto !important;margin-right:24px !important;}}
-@keyframes msgIn{{from{{opacity:0;transform:translateY(10px);}}to{{opacity:1;transform:translateY(0);}}}}
-.stChatMessage p,.stChatMessage li{{font-family:'Figtree',sans-serif !important;
-  font-size:.88rem !important;line-height:1.75 !important;color:{T['text']} !important;}}
-.stChatMessage a{{color:{T['accent']} !important;}}
-.stChatMessage [data-testid="stChatMessageAvatarUser"]{{background:{T['ub']} !important;
-  border:1px solid {T['ubr']} !important;border-radius:8px !important;color:{T['accent']} !important;}}
-.stChatMessage [data-testid="stChatMessageAvatarAssistant"]{{background:{T['ab']} !important;
-  border:1px solid {T['abr']} !important;border-radius:8px !important;color:{T['accent2']} !important;}}
-.stChatMessage code{{font-family:'Space Mono',monospace !important;font-size:.73rem !important;
-  background:{T['bg3']} !important;border:1px solid {T['border']} !important;
-  border-radius:4px !important;padding:1px 5px !important;color:{T['accent']} !important;}}
-.stChatMessage pre{{background:{T['bg2']} !important;border:1px solid {T['border']} !important;
-  border-radius:10px !important;padding:16px !important;}}
-
-/* ── CHAT INPUT ── */
-.stChatInputContainer{{position:fixed !important;bottom:0 !important;left:268px !important;
-  right:0 !important;background:linear-gradient(to top,{T['bg']} 60%,transparent) !important;
-  padding:16px 40px 24px !important;border-top:none !important;z-index:100;}}
-.stChatInputContainer>div{{max-width:820px !important;margin:0 auto !important;}}
-.stChatInput{{background:{T['bg2']} !important;border:1px solid {T['border']} !important;
-  border-radius:12px !important;color:{T['text']} !important;
-  font-family:'Figtree',sans-serif !important;font-size:.88rem !important;
-  padding:13px 16px !important;transition:border-color .2s !important;}}
-.stChatInput:focus{{border-color:{T['accent']}44 !important;
-  box-shadow:0 0 0 3px {T['glow']} !important;outline:none !important;}}
-.stChatInput::placeholder{{color:{T['text_dimmer']} !important;
-  font-family:'Space Mono',monospace !important;font-size:.68rem !important;}}
-.stChatInputContainer button{{background:transparent !important;
-  border:1px solid {T['border']} !important;border-radius:10px !important;
-  color:{T['text_dim']} !important;transition:all .2s !important;}}
-.stChatInputContainer button:hover{{border-color:{T['accent']}44 !important;color:{T['accent']} !important;}}
-
-/* ── MODULE CARDS ── */
-.mcard{{background:{T['bg2']};border:1px solid {T['border']};
-  border-radius:14px;padding:20px;margin-bottom:12px;}}
-.mcard-title{{font-family:'Syne',sans-serif;font-size:1rem;font-weight:800;
-  letter-spacing:-.5px;color:{T['title']};margin-bottom:3px;}}
-.mcard-sub{{font-family:'Space Mono',monospace;font-size:.5rem;color:{T['text_dim']};
-  letter-spacing:2px;text-transform:uppercase;margin-bottom:12px;}}
-.result-text{{font-family:'Figtree',sans-serif;font-size:.88rem;color:{T['text']};line-height:1.75;}}
-.big-num{{font-family:'Syne',sans-serif;font-size:2.8rem;font-weight:800;
-  letter-spacing:-2px;color:{T['accent']};}}
-.weather-meta{{font-family:'Space Mono',monospace;font-size:.58rem;color:{T['text_dim']};
-  margin-top:10px;line-height:2.2;}}
-
-/* ── IMAGE GRID (inline in chat) ── */
-.chat-img-grid{{display:grid;grid-template-columns:repeat(3,1fr);gap:8px;margin-top:12px;}}
-.chat-img-grid a{{display:block;border-radius:10px;overflow:hidden;
-  border:1px solid {T['border']};transition:transform .18s,border-color .18s;}}
-.chat-img-grid a:hover{{transform:scale(1.03);border-color:{T['ubr']};}}
-.chat-img-grid img{{width:100%;height:140px;object-fit:cover;display:block;}}
-.chat-img-caption{{font-family:'Space Mono',monospace;font-size:.48rem;
-  color:{T['text_dimmer']};padding:5px 6px;white-space:nowrap;overflow:hidden;text-overflow:ellipsis;}}
-
-/* ── YT CARD (inline in chat) ── */
-.yt-card{{display:flex;gap:12px;align-items:flex-start;
-  background:{T['bg3']};border:1px solid {T['border']};
-  border-radius:12px;padding:12px;margin-bottom:8px;
-  transition:border-color .18s;}}
-.yt-card:hover{{border-color:{T['ubr']};}}
-.yt-thumb{{width:120px;min-width:120px;border-radius:8px;overflow:hidden;border:1px solid {T['border']};}}
-.yt-thumb img{{width:100%;height:68px;object-fit:cover;display:block;}}
-.yt-info{{flex:1;min-width:0;}}
-.yt-title{{font-family:'Figtree',sans-serif;font-size:.85rem;font-weight:600;
-  color:{T['title']};line-height:1.4;margin-bottom:4px;}}
-.yt-title a{{color:{T['accent']} !important;text-decoration:none;}}
-.yt-title a:hover{{text-decoration:underline;}}
-.yt-channel{{font-family:'Space Mono',monospace;font-size:.52rem;color:{T['text_dim']};
-  letter-spacing:1px;margin-bottom:5px;}}
-.yt-desc{{font-family:'Figtree',sans-serif;font-size:.78rem;color:{T['text_dim']};
-  line-height:1.5;display:-webkit-box;-webkit-line-clamp:2;-webkit-box-orient:vertical;overflow:hidden;}}
-.yt-open{{display:inline-block;margin-top:8px;font-family:'Space Mono',monospace;
-  font-size:.5rem;color:{T['accent']};letter-spacing:1.5px;border:1px solid {T['ubr']};
-  border-radius:5px;padding:4px 10px;text-decoration:none;transition:all .15s;}}
-.yt-open:hover{{background:{T['ub']};}}
-
-/* ── MIC BUTTON ── */
-.mic-area{{max-width:820px;margin:8px auto 0;padding:0 46px;display:flex;align-items:center;gap:12px;}}
-.mic-area.form-mic{{margin:0;padding:2px 0 0 0;width:100%;justify-content:flex-end;}}
-.mic-btn{{display:inline-flex;align-items:center;gap:8px;
-  background:{T['ub']};border:1px solid {T['ubr']};border-radius:8px;
-  color:{T['accent']};font-family:'Space Mono',monospace;font-size:.55rem;
-  letter-spacing:2px;padding:8px 14px;cursor:pointer;transition:all .18s;
-  text-transform:uppercase;white-space:nowrap;height:100%;min-height:38px;}}
-.mic-btn:hover{{box-shadow:0 0 14px {T['glow']};}}
-.mic-hint{{font-family:'Space Mono',monospace;font-size:.5rem;
-  color:{T['text_dim']};letter-spacing:1px;}}
-
-/* ── MISC ── */
-::-webkit-scrollbar{{width:3px;height:3px;}}
-::-webkit-scrollbar-track{{background:transparent;}}
-::-webkit-scrollbar-thumb{{background:{T['border']};border-radius:3px;}}
-.stSuccess,.stError,.stWarning,.stInfo{{border-radius:8px !important;
-  font-family:'Space Mono',monospace !important;font-size:.68rem !important;}}
-.stCaption{{font-family:'Space Mono',monospace !important;font-size:.55rem !important;
-  color:{T['text_dim']} !important;}}
-.main-wrap{{max-width:820px;margin:0 auto;padding:36px 46px 130px;}}
-.page-title{{font-family:'Syne',sans-serif;font-size:2rem;font-weight:800;
-  letter-spacing:-2px;color:{T['title']};line-height:1;margin-bottom:4px;}}
-.page-rule{{height:1px;background:linear-gradient(to right,{T['border']},transparent);
-  margin:13px 0 24px;}}
-</style>
-""", unsafe_allow_html=True)
+# The stylesheet itself is theme-independent (static/iris.css, colours via CSS
+# custom properties). With static serving on it is linked, so the browser
+# fetches it once; each rerun only ships the link and the theme's :root block.
+CSS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "iris.css")
+CSS_ALPHA = re.compile(r'var\(--([a-z0-9-]+?)-([0-9a-f]{2})\)')
+
+@st.cache_resource
+def css_sheet():
+    with open(CSS_PATH, encoding="utf-8") as f:
+        return f.read()
+
+@st.cache_resource
+def stylesheet():
+    sheet = css_sheet()
+    if not st.get_option("server.enableStaticServing"):
+        return f"<style>\n{sheet}</style>\n"
+    ver = hashlib.sha1(sheet.encode()).hexdigest()[:10]
+    return f'<link rel="stylesheet" href="app/static/iris.css?v={ver}">\n'
+
+@st.cache_resource
+def theme_css(name):
+    """:root custom properties for one theme, plus the hex+alpha variants
+    (--accent-55 etc.) the sheet refers to."""
+    t = THEMES[name]
+    props = {k.replace("_", "-"): v for k, v in t.items() if k != "name"}
+    for k, a in sorted(set(CSS_ALPHA.findall(css_sheet()))):
+        props[f"{k}-{a}"] = props[k] + a
+    return "<style>:root{" + ";".join(f"--{k}:{v}" for k, v in props.items()) + "}</style>"
+
+st.markdown(stylesheet() + theme_css(st.session_state.theme), unsafe_allow_html=True)
 
 
 
 # ─── GEMINI 3 PRO CLIENT ──────────────────────────────────────────────────────────────
+# One client per API key for the whole process: the server key is shared by all
+# sessions, a key typed into the sidebar gets its own. Each client owns a
+# keep-alive httpx pool, HTTP/2 through the h2 package that httpx[http2] in
+# requirements.txt pulls in (HTTP/1.1 keep-alive if it is missing), and is
+# retired after LLM_CLIENT_MAX_AGE so long-lived connections get recycled.
+LLM_CLIENT_MAX     = 32
+LLM_CLIENT_MAX_AGE = int(os.getenv("IRIS_LLM_CLIENT_MAX_AGE", "3600"))
+LLM_CLIENT_GRACE   = 120  # s a retired client stays open for in-flight streams
+
+try:
+    import h2  # noqa: F401 — enables httpx HTTP/2
+    LLM_HTTP2 = True
+except ImportError:
+    LLM_HTTP2 = False
+
+class ClientPool:
+    """LRU of Groq clients keyed by a hash of the API key, with a maximum age."""
+    def __init__(self, maxsize=LLM_CLIENT_MAX, max_age=LLM_CLIENT_MAX_AGE):
+        self.maxsize, self.max_age = maxsize, max_age
+        self._clients, self._lock = OrderedDict(), threading.Lock()
+
+    def get(self, key):
+        h = hashlib.sha256(key.encode()).hexdigest()
+        with self._lock:
+            item = self._clients.get(h)
+            if item and time.monotonic() - item[0] < self.max_age:
+                self._clients.move_to_end(h)
+                return item[1]
+            if item:
+                self._retire(self._clients.pop(h)[1])
+            client = Groq(api_key=key, http_client=httpx.Client(
+                http2=LLM_HTTP2, timeout=httpx.Timeout(60, connect=5),
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=8,
+                                    keepalive_expiry=60)))
+            self._clients[h] = (time.monotonic(), client)
+            while len(self._clients) > self.maxsize:
+                self._retire(self._clients.popitem(last=False)[1][1])
+            return client
+
+    def _retire(self, client):
+        t = threading.Timer(LLM_CLIENT_GRACE, client.close)
+        t.daemon = True
+        t.start()
+
+    def __len__(self):
+        return len(self._clients)
+
+@st.cache_resource
+def client_pool():
+    return ClientPool()
+
 def get_client():
     key = os.getenv("GEMINI_API_KEY", "") or st.session_state.get("gemini_key", "")
-    return Groq(api_key=key) if key else None
+    return client_pool().get(key) if key else None
+
+DEFAULT_SYSTEM = (
+    "You are IRIS, a smart AI assistant. Be helpful, concise, and friendly. "
+    "For weather, search, YouTube, images, dictionary, health, math, and translation "
+    "requests — handle them clearly and directly."
+)
+
+def llm_messages(prompt, system=None, include_history=True):
+    history = context_messages(prompt) if include_history else []
+    return [{"role": "system", "content": system or DEFAULT_SYSTEM}] + history + [{"role": "user", "content": prompt}]
+
+def llm_chunks(client, msgs, model, temperature, cancel=None):
+    """Yield content deltas of a streamed completion. Setting `cancel` closes the stream."""
+    completion = client.chat.completions.create(model=model, messages=msgs,
+                                                temperature=temperature, stream=True)
+    try:
+        for chunk in completion:
+            if cancel is not None and cancel.is_set():
+                break
+            d = chunk.choices[0].delta.content if chunk.choices else None
+            if d:
+                yield d
+    finally:
+        completion.close()
+
+def stream_to(placeholder, chunks, fmt=lambda t: t):
+    """Render deltas into `placeholder` as they arrive; fmt wraps the partial text."""
+    text, speech = "", getattr(_call, "speech", None)
+    for d in chunks:
+        if tool_cancelled():
+            return text  # run_tool has rendered the timeout notice; leave it be
+        text += d
+        if speech: speech.feed(d)
+        if placeholder: placeholder.markdown(fmt(text + "▌"))
+    if placeholder and not tool_cancelled(): placeholder.markdown(fmt(text))
+    return text
 
 def llm_stream(prompt, system=None, placeholder=None, include_history=True):
     client = get_client()
@@ -482,26 +935,17 @@ def llm_stream(prompt, system=None, placeholder=None, include_history=True):
         msg = "⚠️ No Gemini API key set."
         if placeholder: placeholder.error(msg)
         return msg
-    sys_msg = system or (
-        "You are IRIS, a smart AI assistant. Be helpful, concise, and friendly. "
-        "For weather, search, YouTube, images, dictionary, health, math, and translation "
-        "requests — handle them clearly and directly."
-    )
-    history = [{"role": m["role"], "content": m["content"]}
-               for m in st.session_state.messages[-20:]] if include_history else []
-    msgs = [{"role": "system", "content": sys_msg}] + history + [{"role": "user", "content": prompt}]
-    resp = ""
+    msgs = llm_messages(prompt, system, include_history)
     try:
-        model = st.session_state.get("model", "llama-3.3-70b-versatile")
+        model = pick_model(prompt, msgs)
         temp  = st.session_state.get("temperature", 0.7)
-        completion = client.chat.completions.create(model=model, messages=msgs,
-                                                    temperature=temp, stream=True)
-        for chunk in completion:
-            d = chunk.choices[0].delta.content
-            if d:
-                resp += d
-                if placeholder: placeholder.markdown(resp + "▌")
-        if placeholder: placeholder.markdown(resp)
+        gen = lambda: stream_to(placeholder, routed_chunks(client, msgs, model, temp))
+        if include_history:
+            resp = gen()
+        else:  # no history: the answer depends only on the prompt, so it is shared
+            resp, hit = llm_cached(model, msgs[0]["content"], prompt, temp, gen)
+            if hit:
+                stream_to(placeholder, [resp])
     except Exception as e:
         resp = f"⚠️ {e}"
         if placeholder: placeholder.error(resp)
@@ -510,48 +954,840 @@ def llm_stream(prompt, system=None, placeholder=None, include_history=True):
 def llm_quick(prompt, system="You are a helpful, concise assistant."):
     client = get_client()
     if not client: return "⚠️ No API key."
+    msgs = [{"role":"system","content":system},{"role":"user","content":prompt}]
+    model = pick_model(prompt, msgs, default=MODEL_SMALL)
     try:
-        r = client.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[{"role":"system","content":system},{"role":"user","content":prompt}],
-            temperature=0.4)
-        return r.choices[0].message.content
+        return llm_cached(model, system, prompt, 0.4,
+                          lambda: routed_complete(client, msgs, model, 0.4))[0]
     except Exception as e:
         return f"⚠️ {e}"
 
+# ─── CONTEXT ──────────────────────────────────────────────────────────────────
+# History is packed newest-first under a token budget. Past assistant turns lose
+# tool boilerplate (link lists, URLs, markdown) first; turns that no longer fit
+# are folded into a per-user rolling summary kept in iris.db next to the messages.
+# Older stored messages that match the prompt are recalled from the search index
+# into a reserved slice of the budget, so a relevant turn isn't lost to recency.
+CONTEXT_TOKENS     = int(os.getenv("IRIS_CONTEXT_TOKENS", "3000"))
+CONTEXT_MSG_TOKENS = 600   # cap for any single past message
+RECALL_TOKENS      = 400   # budget share for recalled messages (at most a quarter)
+RECALL_MSG_TOKENS  = 120
+RECALL_K           = 4
+SUMMARY_MODEL      = "llama-3.1-8b-instant"
+SUMMARY_SYSTEM = (
+    "You maintain a running summary of a chat between a user and the assistant IRIS. "
+    "Merge the new messages into the summary. Keep facts, names, preferences and open "
+    "questions; drop pleasantries. Reply with the summary only, at most 150 words."
+)
+_LINK_LIST = re.compile(r'\n-{3,}\n.*', re.S)   # search results appended under a rule
+_MD_LINK   = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+_URL       = re.compile(r'https?://\S+')
+_MD_MARK   = re.compile(r'[*_`#>|]+')
+
+def est_tokens(text):
+    """Cheap token estimate: ~4 characters per token."""
+    return len(text) // 4 + 1
+
+def clip_tokens(text, n):
+    return text if est_tokens(text) <= n else text[:n * 4].rsplit(" ", 1)[0] + " …"
+
+def strip_boilerplate(text):
+    text = _URL.sub("", _MD_LINK.sub(r"\1", _LINK_LIST.sub("", text)))
+    return re.sub(r"\n\s*\n+", "\n", _MD_MARK.sub("", text)).strip()
+
+def pack_history(msgs, budget):
+    """(kept, dropped): the newest messages that fit in `budget` tokens, trimmed
+    for the prompt, and the untouched older rest."""
+    kept, used = [], 0
+    for i in range(len(msgs) - 1, -1, -1):
+        m = msgs[i]
+        text = m["content"] if m["role"] == "user" else strip_boilerplate(m["content"])
+        text = clip_tokens(text, CONTEXT_MSG_TOKENS)
+        if not text:
+            continue
+        used += est_tokens(text) + 4  # role/framing overhead
+        if used > budget:
+            return kept[::-1], msgs[:i + 1]
+        kept.append({"role": m["role"], "content": text})
+    return kept[::-1], []
+
+def recall(email, prompt, exclude, budget):
+    """Stored messages outside the packed window that match the prompt, as one
+    system message under `budget` tokens (or None)."""
+    lines, used = [], 0
+    for h in get_store().search(email, prompt, limit=RECALL_K, any_term=True,
+                                exclude=exclude, fresh=False):
+        text = h["content"] if h["role"] == "user" else strip_boilerplate(h["content"])
+        line = f"{'User' if h['role'] == 'user' else 'IRIS'}: {clip_tokens(text, RECALL_MSG_TOKENS)}"
+        if used + est_tokens(line) > budget:
+            continue
+        used += est_tokens(line)
+        lines.append((h["seq"], line))
+    if not lines:
+        return None
+    body = "\n".join(l for _, l in sorted(lines))
+    return {"role": "system", "content": f"Earlier messages that may be relevant:\n{body}"}
+
+def context_messages(prompt):
+    """Chat history for an LLM call: rolling summary, recalled older messages
+    and the newest turns, under CONTEXT_TOKENS."""
+    msgs = st.session_state.messages
+    if msgs and msgs[-1]["role"] == "user" and msgs[-1]["content"] == prompt:
+        msgs = msgs[:-1]  # the chat module appends the prompt before the tools run
+    email = st.session_state.get("user_email")
+    summary = get_store().summary(email) if email else None
+    budget = CONTEXT_TOKENS - (est_tokens(summary[0]) if summary else 0)
+    kept, dropped = pack_history(msgs, budget)
+    recalled = None
+    if dropped and email:
+        reserve = min(RECALL_TOKENS, budget // 4)
+        kept, dropped = pack_history(msgs, budget - reserve)
+        schedule_summary(email, msgs, dropped, summary)
+        with span("recall") as sp:
+            recalled = recall(email, prompt, [m["id"] for m in msgs[len(dropped):] if m.get("id")], reserve)
+            sp["hit"] = recalled is not None
+    head = [{"role": "system", "content": f"Summary of the earlier conversation: {summary[0]}"}] if summary else []
+    return head + ([recalled] if recalled else []) + kept
+
+@st.cache_resource
+def summary_jobs():
+    return set(), threading.Lock()
+
+def schedule_summary(email, msgs, dropped, summary):
+    """Fold dropped messages not yet in the summary into it, in the background."""
+    upto = summary[1] if summary else None
+    done = next((i for i, m in enumerate(msgs) if m.get("id") == upto), -1)
+    new = [m for m in dropped[done + 1:] if m.get("id")]
+    client = get_client()
+    if not new or not client:
+        return
+    busy, lock = summary_jobs()
+    with lock:
+        if email in busy:
+            return
+        busy.add(email)
+    submit(refresh_summary, client, email, summary[0] if summary else "", new,
+           get_store().generation(email))
+
+def refresh_summary(client, email, prev, msgs, generation=None):
+    busy, lock = summary_jobs()
+    try:
+        lines = "\n".join(f"{m['role']}: {clip_tokens(strip_boilerplate(m['content']), 200)}"
+                          for m in msgs)
+        with admission("groq").slot(user=email):
+            r = client.chat.completions.create(
+                model=SUMMARY_MODEL, temperature=0.2,
+                messages=[{"role": "system", "content": SUMMARY_SYSTEM},
+                          {"role": "user", "content": f"Summary so far:\n{prev or '(none)'}\n\n"
+                                                      f"New messages:\n{lines}"}])
+        text = (r.choices[0].message.content or "").strip()
+        if text:
+            # dropped if RESET cleared the history while the model was answering
+            get_store().set_summary(email, text, msgs[-1]["id"], generation)
+    except Exception:
+        pass # retried when the next call overflows the budget
+    finally:
+        with lock:
+            busy.discard(email)
+
+# ─── MODEL ROUTER ─────────────────────────────────────────────────────────────
+# Each call goes to the 8B or the 70B model depending on the intent or module,
+# the prompt length, the history size and a few reasoning cues. When an 8B reply
+# opens by hedging, it is dropped and the 70B model answers instead; the switch
+# happens before anything reaches the page. Per-model stats feed the thresholds.
+MODEL_SMALL, MODEL_LARGE = "llama-3.1-8b-instant", "llama-3.3-70b-versatile"
+ROUTE_LARGE_INTENTS = {"health", "translate", "translator", "calculate", "calculator"}
+ROUTE_PROMPT_TOKENS  = 60     # longer prompts go to the large model
+ROUTE_HISTORY_TOKENS = 1500   # as do calls carrying this much history
+ROUTE_ESCALATE    = os.getenv("IRIS_ROUTE_ESCALATE", "1") == "1"
+ROUTE_HEDGE_CHARS = 160       # opening of an 8B reply checked before it is shown
+ROUTE_HARD = re.compile(r'\b(why|explain|compare|difference between|step by step|prove|'
+                        r'analy[sz]e|derive|code|program|debug|essay|plan)\b', re.I)
+LOW_CONFIDENCE = re.compile(r"\b(i'?m not sure|i am not sure|i don'?t know|i do not know|"
+                            r"i can'?t (?:help|answer|provide)|i cannot (?:help|answer|provide)|"
+                            r"not (?:able|enough information) to)\b", re.I)
+
+def pick_model(prompt, msgs, default=None):
+    """Model id for one call. A session "model" other than "auto" pins it."""
+    pinned = st.session_state.get("model", "auto")
+    if pinned != "auto":
+        return pinned
+    intent = getattr(_call, "intent", None) or st.session_state.get("active_module")
+    history = sum(est_tokens(m["content"]) for m in msgs[1:-1])
+    if (intent in ROUTE_LARGE_INTENTS or est_tokens(prompt) > ROUTE_PROMPT_TOKENS
+            or history > ROUTE_HISTORY_TOKENS or ROUTE_HARD.search(prompt)):
+        return MODEL_LARGE
+    return default or MODEL_SMALL
+
+class ModelStats:
+    """Per-model call counts, latency/TTFT samples and estimated token totals."""
+    def __init__(self, samples=500):
+        self.samples, self._lock, self._m = samples, threading.Lock(), {}
+
+    def _get(self, model):
+        return self._m.setdefault(model, {
+            "calls": 0, "aborted": 0, "escalated": 0, "tokens_in": 0, "tokens_out": 0,
+            "latency": deque(maxlen=self.samples), "ttft": deque(maxlen=self.samples)})
+
+    def record(self, model, latency, ttft, tokens_in, tokens_out, ok):
+        with self._lock:
+            m = self._get(model)
+            m["calls"] += 1
+            m["aborted"] += not ok
+            m["tokens_in"] += tokens_in
+            m["tokens_out"] += tokens_out
+            m["latency"].append(latency)
+            if ttft is not None:
+                m["ttft"].append(ttft)
+
+    def escalated(self, model):
+        with self._lock:
+            self._get(model)["escalated"] += 1
+
+    def snapshot(self):
+        def pct(xs, q):
+            xs = sorted(xs)
+            return round(xs[min(len(xs) - 1, int(q * len(xs)))], 3) if xs else None
+        with self._lock:
+            return {model: {**{k: v for k, v in m.items() if k not in ("latency", "ttft")},
+                            "p50": pct(m["latency"], .5), "p95": pct(m["latency"], .95),
+                            "ttft_p50": pct(m["ttft"], .5)}
+                    for model, m in self._m.items()}
+
+@st.cache_resource
+def model_stats():
+    return ModelStats()
+
+def timed_chunks(client, msgs, model, temperature, cancel=None):
+    """llm_chunks admitted through the groq provider and recorded in model_stats()."""
+    with admission("groq").slot(), span(f"llm {model}") as sp:
+        t0, ttft, out, ok = time.perf_counter(), None, 0, False
+        try:
+            for d in llm_chunks(client, msgs, model, temperature, cancel):
+                if ttft is None:
+                    ttft = time.perf_counter() - t0
+                out += len(d)
+                yield d
+            ok = cancel is None or not cancel.is_set()
+        finally:
+            tokens_in = sum(est_tokens(m["content"]) for m in msgs)
+            sp.update(ttft_ms=round((ttft or 0) * 1000, 1), tokens_in=tokens_in, tokens_out=out // 4)
+            model_stats().record(model, time.perf_counter() - t0, ttft, tokens_in, out // 4, ok)
+
+def routed_chunks(client, msgs, model, temperature, cancel=None):
+    """timed_chunks, escalating to MODEL_LARGE when an 8B reply opens by hedging."""
+    chunks = timed_chunks(client, msgs, model, temperature, cancel)
+    if model != MODEL_SMALL or not ROUTE_ESCALATE:
+        yield from chunks
+        return
+    head = ""
+    for d in chunks:
+        head += d
+        if len(head) >= ROUTE_HEDGE_CHARS:
+            break
+    if head.strip() and not LOW_CONFIDENCE.search(head):
+        yield head
+        yield from chunks
+        return
+    chunks.close()
+    model_stats().escalated(model)
+    yield from timed_chunks(client, msgs, MODEL_LARGE, temperature, cancel)
+
+def routed_complete(client, msgs, model, temperature):
+    """Non-streamed counterpart of routed_chunks."""
+    def complete(m):
+        with admission("groq").slot(), span(f"llm {m}"):
+            t0 = time.perf_counter()
+            r = client.chat.completions.create(model=m, messages=msgs, temperature=temperature)
+        text = r.choices[0].message.content or ""
+        dt = time.perf_counter() - t0
+        model_stats().record(m, dt, dt, sum(est_tokens(x["content"]) for x in msgs),
+                             est_tokens(text), True)
+        return text
+    text = complete(model)
+    if model == MODEL_SMALL and ROUTE_ESCALATE and (
+            not text.strip() or LOW_CONFIDENCE.search(text[:ROUTE_HEDGE_CHARS])):
+        model_stats().escalated(model)
+        text = complete(MODEL_LARGE)
+    return text
+
+# ─── HTTP ─────────────────────────────────────────────────────────────────────
+# One keep-alive session per process for every outbound integration, so
+# repeat calls reuse pooled TCP+TLS connections instead of handshaking.
+HTTP_POOL_SIZE = int(os.getenv("IRIS_HTTP_POOL_SIZE", "16"))
+HTTP_RETRIES   = int(os.getenv("IRIS_HTTP_RETRIES", "2"))
+# Upstream base URLs; bench/stubs.py points them at local stand-ins
+# (Groq's client reads GROQ_BASE_URL itself).
+GOOGLE_API_BASE   = os.getenv("IRIS_GOOGLE_API_BASE", "https://www.googleapis.com")
+GEOCODE_API_BASE  = os.getenv("IRIS_GEOCODE_API_BASE", "https://geocoding-api.open-meteo.com")
+FORECAST_API_BASE = os.getenv("IRIS_FORECAST_API_BASE", "https://api.open-meteo.com")
+HTTP_TIMEOUTS  = {  # (connect, read) seconds per host
+    "www.googleapis.com":           (3, 8),
+    "geocoding-api.open-meteo.com": (3, 5),
+    "api.open-meteo.com":           (3, 8),
+}
+HTTP_DEFAULT_TIMEOUT = (3, 8)
+HTTP_RETRY_AFTER_MAX = 2.0  # seconds; a retry sleeps inside the caller's slot
+
+class CappedRetry(Retry):
+    """Retry that honours Retry-After only up to HTTP_RETRY_AFTER_MAX."""
+    def get_retry_after(self, response):
+        after = super().get_retry_after(response)
+        return None if after is None else min(after, HTTP_RETRY_AFTER_MAX)
+
+@st.cache_resource
+def http_session():
+    # retry connect errors and 429/5xx with backoff (honouring a capped Retry-After);
+    # read timeouts are not retried so a slow API can't multiply the wait
+    retry = CappedRetry(total=HTTP_RETRIES, read=0, backoff_factor=0.3,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset({"GET"}),
+                  respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+class Throttled(requests.HTTPError):
+    """A 429 that outlived the retries; Provider.slot backs off on it."""
+
+def http_get(url, params=None):
+    host = urllib.parse.urlsplit(url).hostname
+    with span(f"http {host}") as sp:
+        r = http_session().get(url, params=params,
+                               timeout=HTTP_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT))
+        sp.update(status=r.status_code, bytes=len(r.content))
+        if r.status_code == 429:
+            raise Throttled(f"{host} rate limit reached, try again in a moment", response=r)
+        return r
+
+# ─── CACHING ──────────────────────────────────────────────────────────────────
+CACHE_DB = os.getenv("IRIS_CACHE_DB", "cache.db")
+
+class TTLCache:
+    """Thread-safe LRU with per-entry expiry and hit/miss counters.
+    With stale > 0, expired entries are kept that much longer for lookup()."""
+    def __init__(self, maxsize=256, ttl=300, stale=0):
+        self.maxsize, self.ttl, self.stale = maxsize, ttl, stale
+        self._data, self._lock = OrderedDict(), threading.Lock()
+        self.hits = self.misses = self.stale_hits = 0
+
+    def lookup(self, key):
+        """(value, fresh) or None."""
+        with self._lock:
+            item, now = self._data.get(key), time.monotonic()
+            if item is None or item[0] + self.stale < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            fresh = item[0] >= now
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+            return item[1], fresh
+
+    def get(self, key, default=None):
+        hit = self.lookup(key)
+        return hit[0] if hit and hit[1] else default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "stale": self.stale_hits, "size": len(self._data)}
+
+class DiskCache:
+    """Size-bounded SQLite tier that survives restarts.
+    Values are JSON-serialisable objects or raw bytes; least recently used go first."""
+    def __init__(self, path, max_bytes=64 << 20, stale=0, table="cache"):
+        self.path, self.max_bytes, self.stale, self.t = path, max_bytes, stale, table
+        self._local, self._writes = threading.local(), 0
+        c = self._conn()
+        with c:
+            c.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY, value BLOB NOT NULL, is_json INTEGER NOT NULL,
+                expires REAL NOT NULL, atime REAL NOT NULL, size INTEGER NOT NULL)""")
+            c.execute(f"CREATE INDEX IF NOT EXISTS {table}_atime ON {table}(atime)")
+
+    def _conn(self):
+        return sqlite_conn(self._local, self.path)
+
+    def get(self, key):
+        """(value, expires) or None; `expires` is a time.time() timestamp."""
+        c = self._conn()
+        row = c.execute(f"SELECT value, is_json, expires FROM {self.t} WHERE key=?", (key,)).fetchone()
+        if row is None or row[2] + self.stale < time.time():
+            return None
+        with c:
+            c.execute(f"UPDATE {self.t} SET atime=? WHERE key=?", (time.time(), key))
+        value = json.loads(row[0]) if row[1] else bytes(row[0])
+        return value, row[2]
+
+    def set(self, key, value, ttl):
+        is_json = not isinstance(value, (bytes, bytearray))
+        blob = json.dumps(value).encode() if is_json else bytes(value)
+        now = time.time()
+        c = self._conn()
+        with c:
+            c.execute(f"INSERT OR REPLACE INTO {self.t} VALUES (?,?,?,?,?,?)",
+                      (key, blob, int(is_json), now + ttl, now, len(blob)))
+        self._writes += 1
+        if self._writes % 50 == 1:
+            self.evict()
+
+    def evict(self):
+        c = self._conn()
+        with c:
+            c.execute(f"DELETE FROM {self.t} WHERE expires + ? < ?", (self.stale, time.time()))
+            total = c.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.t}").fetchone()[0]
+            for key, size in c.execute(f"SELECT key, size FROM {self.t} ORDER BY atime").fetchall():
+                if total <= self.max_bytes:
+                    break
+                c.execute(f"DELETE FROM {self.t} WHERE key=?", (key,))
+                total -= size
+
+class ResponseCache:
+    """Memory LRU in front of an optional disk tier.
+    With swr, a stale entry is returned at once and refreshed in the background."""
+    def __init__(self, maxsize=1024, disk=None, swr=True, stale=24 * 3600):
+        self.mem = TTLCache(maxsize, stale=stale)
+        self.disk, self.swr = disk, swr
+        self._refreshing, self._lock = set(), threading.Lock()
+
+    def fetch(self, key, loader, ttl):
+        """loader() -> (data, err). Only successful results are cached."""
+        hit = self.mem.lookup(key)
+        if hit is None and self.disk:
+            row = self.disk.get(key)
+            if row:
+                left = row[1] - time.time()
+                self.mem.set(key, row[0], ttl=left)
+                hit = (row[0], left > 0)
+        if hit and hit[1]:
+            note(cache="hit")
+            return hit[0], None
+        if hit and self.swr:
+            note(cache="stale")
+            self._refresh(key, loader, ttl)
+            return hit[0], None
+        note(cache="miss")
+        return self._load(key, loader, ttl)
+
+    def _load(self, key, loader, ttl):
+        data, err = loader()
+        if err is None:
+            self.mem.set(key, data, ttl)
+            if self.disk:
+                self.disk.set(key, data, ttl)
+        return data, err
+
+    def _refresh(self, key, loader, ttl):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        def run():
+            try:
+                self._load(key, loader, ttl)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        threading.Thread(target=run, name="iris-swr", daemon=True).start()
+
+    def stats(self):
+        return self.mem.stats()
+
+# Geocodes barely change: keep many for a week. Forecasts go stale in minutes.
+@st.cache_resource
+def weather_caches():
+    return {"geocode":  TTLCache(maxsize=2048, ttl=7 * 24 * 3600),
+            "forecast": TTLCache(maxsize=512,  ttl=10 * 60)}
+
+# Google / YouTube responses, per endpoint. IRIS_API_CACHE_DISK=0 keeps them
+# in memory only; IRIS_API_CACHE_SWR=0 makes expired entries block on a refetch.
+API_CACHE_TTL  = {"search": 30 * 60, "images": 24 * 3600, "youtube": 6 * 3600}
+API_PROVIDER   = {"search": "google", "images": "google", "youtube": "youtube"}
+API_CACHE_DISK = os.getenv("IRIS_API_CACHE_DISK", "1") == "1"
+API_CACHE_SWR  = os.getenv("IRIS_API_CACHE_SWR", "1") == "1"
+
+@st.cache_resource
+def api_cache():
+    stale = 24 * 3600
+    disk = DiskCache(CACHE_DB, stale=stale) if API_CACHE_DISK else None
+    return ResponseCache(maxsize=1024, disk=disk, swr=API_CACHE_SWR, stale=stale)
+
+def norm_query(q):
+    return " ".join(q.lower().split()).strip(" ?.!,")
+
+def cached_api(endpoint):
+    """Serve fn(query, ...) -> (data, err) through api_cache(), keyed on the
+    normalised query plus every other argument (defaults filled in)."""
+    def deco(fn):
+        sig = inspect.signature(fn)
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            b = sig.bind(*args, **kwargs)
+            b.apply_defaults()
+            a = dict(b.arguments, query=norm_query(b.arguments["query"]))
+            key = f"{endpoint}:" + json.dumps(a, sort_keys=True)
+            def load():
+                p = admission(API_PROVIDER[endpoint])
+                def call():
+                    with p.slot():
+                        return fn(*args, **kwargs)
+                try:
+                    return p.flights.do(key, call)[0]
+                except (Overloaded, Throttled) as e:
+                    return None, str(e)
+            with span(f"api.{endpoint}"):
+                return api_cache().fetch(key, load, API_CACHE_TTL[endpoint])
+        return wrapper
+    return deco
+
+# Synthesised speech is content-addressed (text + lang), so it never goes stale;
+# the disk tier is bounded by size instead (IRIS_TTS_CACHE_MB).
+TTS_CACHE_TTL = 30 * 24 * 3600
+TTS_CACHE_MB  = int(os.getenv("IRIS_TTS_CACHE_MB", "256"))
+
+@st.cache_resource
+def tts_cache():
+    disk = DiskCache(CACHE_DB, max_bytes=TTS_CACHE_MB << 20, table="tts")
+    return ResponseCache(maxsize=128, disk=disk, swr=False, stale=0)
+
+# LLM answers that do not depend on chat history (dictionary, word problems,
+# module lookups), shared across users. Keyed on model,
+# system prompt, normalised prompt and a 0.2-wide temperature bucket.
+# IRIS_LLM_CACHE_SIM (e.g. 0.95) also serves a cached answer for a prompt whose
+# bag of words is that similar. It is off by default: templated prompts that
+# differ in a single word ("define affect" / "define effect") score close to 1.
+LLM_CACHE     = os.getenv("IRIS_LLM_CACHE", "1") == "1"
+LLM_CACHE_TTL = 7 * 24 * 3600
+LLM_CACHE_MB  = int(os.getenv("IRIS_LLM_CACHE_MB", "64"))
+LLM_CACHE_SIM = float(os.getenv("IRIS_LLM_CACHE_SIM", "0"))
+
+class SimilarityIndex:
+    """Hashed bag-of-words vectors per namespace, searched by cosine similarity."""
+    def __init__(self, dim=1024, per_ns=2048):
+        self.dim, self.per_ns = dim, per_ns
+        self._ns, self._lock = {}, threading.Lock()
+
+    def _vec(self, text):
+        v = {}
+        for w in re.findall(r"\w+", text):
+            h = hash(w) % self.dim
+            v[h] = v.get(h, 0) + 1
+        n = sum(x * x for x in v.values()) ** 0.5 or 1
+        return {h: x / n for h, x in v.items()}
+
+    def add(self, ns, text, key):
+        with self._lock:
+            d = self._ns.setdefault(ns, OrderedDict())
+            d[key] = self._vec(text)
+            d.move_to_end(key)
+            while len(d) > self.per_ns:
+                d.popitem(last=False)
+
+    def nearest(self, ns, text, threshold):
+        """Key of the most similar entry scoring at least `threshold`, or None."""
+        q = self._vec(text)
+        with self._lock:
+            best, key = threshold, None
+            for k, v in self._ns.get(ns, {}).items():
+                score = sum(x * v.get(h, 0) for h, x in q.items())
+                if score >= best:
+                    best, key = score, k
+            return key
+
+@st.cache_resource
+def llm_cache():
+    disk = DiskCache(CACHE_DB, max_bytes=LLM_CACHE_MB << 20, table="llm")
+    return ResponseCache(maxsize=512, disk=disk, swr=False, stale=0)
+
+@st.cache_resource
+def llm_index():
+    return SimilarityIndex()
+
+def llm_cached(model, system, prompt, temperature, generate):
+    """(text, hit): generate() -> text, served from llm_cache() when possible.
+    Errors, empty and cancelled answers are not stored."""
+    if not LLM_CACHE:
+        return generate(), False
+    q, t = norm_query(prompt), round(temperature * 5) / 5
+    ns = hashlib.sha256(json.dumps([model, system, t]).encode()).hexdigest()[:16]
+    key = f"llm:{ns}:" + hashlib.sha256(q.encode()).hexdigest()
+    generated = []
+    def load():
+        if LLM_CACHE_SIM:
+            twin = llm_index().nearest(ns, q, LLM_CACHE_SIM)
+            if twin:
+                text, err = llm_cache().fetch(twin, lambda: (None, "miss"), LLM_CACHE_TTL)
+                if err is None:
+                    return text, None
+        # identical calls in flight at the same time share one generation
+        text, leader = admission("groq").flights.do(key, generate)
+        if not leader:
+            return text, "shared"
+        generated.append(True)
+        if not text or text.startswith("⚠️") or tool_cancelled():
+            return text, "not cacheable"
+        llm_index().add(ns, q, key)
+        return text, None
+    with span("llm.cache"):
+        text, _ = llm_cache().fetch(key, load, LLM_CACHE_TTL)
+    return text, not generated
+
+def cache_stats():
+    return {**{n: c.stats() for n, c in weather_caches().items()},
+            "api": api_cache().stats(), "tts": tts_cache().stats(), "llm": llm_cache().stats()}
+
+# ─── BACKGROUND WORK ──────────────────────────────────────────────────────────
+@st.cache_resource
+def io_pool():
+    return ThreadPoolExecutor(max_workers=16, thread_name_prefix="iris-io")
+
+def submit(fn, *args, pool=None, **kwargs):
+    """Run fn on a worker pool (io_pool by default) with this session's script
+    context attached, so st.cache_* helpers called from the worker resolve normally."""
+    ctx, trace = get_script_run_ctx(), current_trace()
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        bind_trace(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            bind_trace(None)
+    return (pool or io_pool()).submit(run)
+
+class TokenStream:
+    """A streamed completion running on a worker, buffered for the script thread."""
+    def __init__(self, client, msgs, model, temperature):
+        self._q, self._cancel = queue.Queue(), threading.Event()
+        self.error = None
+        self.future = submit(self._run, client, msgs, model, temperature)
+
+    def _run(self, client, msgs, model, temperature):
+        try:
+            for d in routed_chunks(client, msgs, model, temperature, cancel=self._cancel):
+                self._q.put(d)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._q.put(None)
+
+    def cancel(self):
+        self._cancel.set()
+
+    def __iter__(self):
+        while (d := self._q.get()) is not None:
+            yield d
+        if self.error:
+            raise self.error
+
+# ─── ADMISSION ────────────────────────────────────────────────────────────────
+# Shared front door for each upstream API: a token bucket paces requests (and
+# backs off after a 429), a gate caps concurrent calls with a bounded queue
+# served round-robin by user, and identical requests already in flight are
+# coalesced into one upstream call. A full queue fails fast with Overloaded.
+ADMIT_TIMEOUT = 20  # s a call may wait for a slot
+PROVIDERS = {       # requests/s, burst, concurrent calls, queued calls
+    "groq":    (float(os.getenv("IRIS_GROQ_RPS", "8")),    16, 24, 96),
+    "google":  (float(os.getenv("IRIS_GOOGLE_RPS", "5")),  10,  8, 48),
+    "youtube": (float(os.getenv("IRIS_YOUTUBE_RPS", "5")), 10,  8, 48),
+}
+
+class Overloaded(RuntimeError):
+    pass
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.t = float(burst), time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+                self.t = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                delay = (1 - self.tokens) / self.rate
+            if now + delay > deadline:
+                return False
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Hold new requests back for `seconds` (after an upstream 429)."""
+        with self._lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class FairGate:
+    """At most `slots` calls at once. Waiters queue per user and are served
+    round-robin, so one busy session cannot starve the others."""
+    def __init__(self, slots, max_queue):
+        self.free, self.max_queue = slots, max_queue
+        self._waiting, self.queued = OrderedDict(), 0
+        self._lock = threading.Lock()
+
+    def acquire(self, user, timeout):
+        with self._lock:
+            if self.free and not self.queued:
+                self.free -= 1
+                return
+            if self.queued >= self.max_queue:
+                raise Overloaded("IRIS is busy right now, try again in a moment")
+            ev = threading.Event()
+            self._waiting.setdefault(user, deque()).append(ev)
+            self.queued += 1
+        if ev.wait(timeout):
+            return
+        with self._lock:
+            if ev.is_set():
+                return  # handed a slot just as the wait timed out
+            q = self._waiting[user]
+            q.remove(ev)
+            self.queued -= 1
+            if not q:
+                del self._waiting[user]
+        raise Overloaded("IRIS is busy right now, try again in a moment")
+
+    def release(self):
+        with self._lock:
+            if not self.queued:
+                self.free += 1
+                return
+            user, q = next(iter(self._waiting.items()))
+            del self._waiting[user]
+            if len(q) > 1:
+                self._waiting[user] = q  # back of the line
+            self.queued -= 1
+            q.popleft().set()  # the slot passes straight to the waiter
+
+class SingleFlight:
+    def __init__(self):
+        self._calls, self._lock = {}, threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """(result, leader): concurrent calls with the same key share one fn() run."""
+        with self._lock:
+            fut, leader = self._calls.get(key), False
+            if fut is None:
+                fut, leader = Future(), True
+                self._calls[key] = fut
+            else:
+                self.coalesced += 1
+        if not leader:
+            return fut.result(), False
+        try:
+            res = fn()
+            fut.set_result(res)
+            return res, True
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+class Provider:
+    def __init__(self, name, rate, burst, slots, max_queue):
+        self.name = name
+        self.bucket, self.gate = TokenBucket(rate, burst), FairGate(slots, max_queue)
+        self.flights = SingleFlight()
+        self.calls = self.rejected = self.throttled = 0
+
+    @contextlib.contextmanager
+    def slot(self, user=None):
+        try:
+            self.gate.acquire(user or current_user(), ADMIT_TIMEOUT)
+        except Overloaded:
+            self.rejected += 1
+            raise
+        try:
+            if not self.bucket.acquire(ADMIT_TIMEOUT):
+                self.rejected += 1
+                raise Overloaded(f"{self.name} rate limit reached, try again in a moment")
+            self.calls += 1
+            yield
+        except Exception as e:
+            if getattr(e, "status_code", None) == 429 or getattr(
+                    getattr(e, "response", None), "status_code", None) == 429:
+                self.throttled += 1
+                self.bucket.pause(2)
+            raise
+        finally:
+            self.gate.release()
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.flights.coalesced,
+                "rejected": self.rejected, "throttled": self.throttled,
+                "queued": self.gate.queued}
+
+@st.cache_resource
+def providers():
+    return {name: Provider(name, *cfg) for name, cfg in PROVIDERS.items()}
+
+def admission(name):
+    return providers()[name]
+
+def current_user():
+    try:
+        return st.session_state.get("user_email") or "anon"
+    except Exception:  # no script context on this thread
+        return "anon"
+
 # ─── GOOGLE SEARCH ────────────────────────────────────────────────────────────
+@cached_api("search")
 def google_search(query, num=5):
     key = os.getenv("GOOGLE_API_KEY",""); cse = os.getenv("GOOGLE_CSE_ID","")
     if not key or not cse: return None, "Missing GOOGLE_API_KEY or GOOGLE_CSE_ID"
     try:
-        r = requests.get("https://www.googleapis.com/customsearch/v1",
-            params={"key":key,"cx":cse,"q":query,"num":num}, timeout=8)
+        r = http_get(f"{GOOGLE_API_BASE}/customsearch/v1",
+            params={"key":key,"cx":cse,"q":query,"num":num})
         d = r.json()
         if "items" not in d: return None, d.get("error",{}).get("message","No results")
         return [{"title":i["title"],"link":i["link"],"snippet":i.get("snippet","")} for i in d["items"]], None
+    except Throttled: raise  # let the provider slot see it and back off
     except Exception as e: return None, str(e)
 
 # ─── GOOGLE IMAGE SEARCH ──────────────────────────────────────────────────────
+@cached_api("images")
 def google_image_search(query, num=6):
     key = os.getenv("GOOGLE_API_KEY",""); cse = os.getenv("GOOGLE_CSE_ID","")
     if not key or not cse: return None, "Missing GOOGLE_API_KEY or GOOGLE_CSE_ID"
     try:
-        r = requests.get("https://www.googleapis.com/customsearch/v1",
-            params={"key":key,"cx":cse,"q":query,"num":num,"searchType":"image"}, timeout=8)
+        r = http_get(f"{GOOGLE_API_BASE}/customsearch/v1",
+            params={"key":key,"cx":cse,"q":query,"num":num,"searchType":"image"})
         d = r.json()
         if "items" not in d: return None, d.get("error",{}).get("message","No images")
         return [{"title":i["title"],"link":i["link"],
                  "thumb":i.get("image",{}).get("thumbnailLink",i["link"])} for i in d["items"]], None
+    except Throttled: raise  # let the provider slot see it and back off
     except Exception as e: return None, str(e)
 
 # ─── YOUTUBE SEARCH ───────────────────────────────────────────────────────────
+@cached_api("youtube")
 def youtube_search(query, max_results=5, search_type="video"):
     key = os.getenv("YOUTUBE_API_KEY","")
     if not key: return None, "Missing YOUTUBE_API_KEY"
     try:
-        r = requests.get("https://www.googleapis.com/youtube/v3/search",
+        r = http_get(f"{GOOGLE_API_BASE}/youtube/v3/search",
             params={"key":key,"q":query,"part":"snippet","maxResults":max_results,
-                    "type":search_type}, timeout=8)
+                    "type":search_type})
         d = r.json()
         if "items" not in d: return None, d.get("error",{}).get("message","No results")
         items = []
@@ -564,26 +1800,43 @@ def youtube_search(query, max_results=5, search_type="video"):
                 "url":(f"https://www.youtube.com/watch?v={vid}" if search_type=="video"
                        else f"https://www.youtube.com/playlist?list={vid}")})
         return items, None
+    except Throttled: raise  # let the provider slot see it and back off
     except Exception as e: return None, str(e)
 
 # ─── WEATHER (Open-Meteo) ───────────────────────────────────────────────────────
 def get_weather(city, unit="metric"):
+    with span("weather", city=city):
+        return _get_weather(city, unit)
+
+def _get_weather(city, unit):
     try:
-        # 1. Geocode
-        geo_url = f"https://geocoding-api.open-meteo.com/v1/search?name={urllib.parse.quote(city)}&count=1&language=en&format=json"
-        geo_r = requests.get(geo_url, timeout=8)
-        geo_d = geo_r.json()
-        if not geo_d.get("results"): return None, f"City not found: {city}"
-        loc = geo_d["results"][0]
-        lat, lon = loc["latitude"], loc["longitude"]
+        caches = weather_caches()
+
+        # 1. Geocode (cached by normalised city name)
+        geo_key = " ".join(city.lower().split())
+        loc = caches["geocode"].get(geo_key)
+        note(geocode="miss" if loc is None else "hit")
+        if loc is None:
+            geo_url = f"{GEOCODE_API_BASE}/v1/search?name={urllib.parse.quote(city)}&count=1&language=en&format=json"
+            geo_r = http_get(geo_url)
+            geo_d = geo_r.json()
+            if not geo_d.get("results"): return None, f"City not found: {city}"
+            loc = geo_d["results"][0]
+            caches["geocode"].set(geo_key, loc)
+        lat, lon = round(loc["latitude"], 2), round(loc["longitude"], 2)
         city_name = loc.get("name", city)
         country = loc.get("country", "")
 
-        # 2. Weather
-        unit_str = "&temperature_unit=fahrenheit&wind_speed_unit=mph" if unit == "imperial" else "&wind_speed_unit=kmh"
-        w_url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,apparent_temperature,precipitation,weather_code,surface_pressure,wind_speed_10m,wind_direction_10m,visibility&daily=weather_code,temperature_2m_max,temperature_2m_min,sunrise,sunset,uv_index_max&timezone=auto{unit_str}"
-        w_r = requests.get(w_url, timeout=8)
-        w_d = w_r.json()
+        # 2. Weather (cached by rounded lat/lon + unit)
+        w_key = (lat, lon, unit)
+        w_d = caches["forecast"].get(w_key)
+        note(forecast="miss" if w_d is None else "hit")
+        if w_d is None:
+            unit_str = "&temperature_unit=fahrenheit&wind_speed_unit=mph" if unit == "imperial" else "&wind_speed_unit=kmh"
+            w_url = f"{FORECAST_API_BASE}/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,apparent_temperature,precipitation,weather_code,surface_pressure,wind_speed_10m,wind_direction_10m,visibility&daily=weather_code,temperature_2m_max,temperature_2m_min,sunrise,sunset,uv_index_max&timezone=auto{unit_str}"
+            w_r = http_get(w_url)
+            w_d = w_r.json()
+            if "current" in w_d: caches["forecast"].set(w_key, w_d)
 
         cur = w_d["current"]
         daily = w_d["daily"]
@@ -626,11 +1879,13 @@ def get_weather(city, unit="metric"):
 # ─── RENDER HELPERS (used both in chat and dedicated modules) ─────────────────
 import textwrap
 
-def render_image_grid(imgs, query=""):
-    """Render a 3-col image grid. Works inside st.chat_message or standalone."""
+# The *_html builders return theme-independent markup (colours via CSS vars),
+# so chat history can cache the fragments across reruns and theme switches.
+def image_grid_html(imgs, query=""):
+    """A 3-col image grid. Works inside st.chat_message or standalone."""
     grid_html = textwrap.dedent(f"""
     <div style='margin-top:10px;'>
-      <div style='font-family:Space Mono,monospace;font-size:.52rem;color:{T['text_dim']};
+      <div style='font-family:Space Mono,monospace;font-size:.52rem;color:var(--text-dim);
                   letter-spacing:2px;text-transform:uppercase;margin-bottom:8px;'>
         🖼 Images · {query}
       </div>
@@ -643,13 +1898,11 @@ def render_image_grid(imgs, query=""):
                onerror="this.style.display='none'">
           <div class='chat-img-caption'>{img['title'][:45]}</div>
         </a>""")
-    grid_html += "</div></div>"
-    st.markdown(grid_html, unsafe_allow_html=True)
+    return grid_html + "</div></div>"
 
-def render_yt_cards(videos):
-    """Render YouTube video cards with thumbnails."""
-    for v in videos:
-        st.markdown(textwrap.dedent(f"""
+def yt_cards_html(videos):
+    """YouTube video cards with thumbnails."""
+    return "".join(textwrap.dedent(f"""
         <div class='yt-card'>
           <div class='yt-thumb'>
             <a href='{v['url']}' target='_blank'>
@@ -663,15 +1916,15 @@ def render_yt_cards(videos):
             <a class='yt-open' href='{v['url']}' target='_blank'>▶ WATCH ON YOUTUBE</a>
           </div>
         </div>
-        """), unsafe_allow_html=True)
+        """) for v in videos)
 
-def render_weather_card(w):
+def weather_card_html(w):
     desc_l = w['desc'].lower()
     emoji = ("⛈" if "thunder" in desc_l else "🌧" if "rain" in desc_l else
              "🌦" if "drizzle" in desc_l else "❄️" if "snow" in desc_l else
              "🌫" if "fog" in desc_l or "mist" in desc_l else
              "🌤" if "cloud" in desc_l else "☀️")
-    st.markdown(textwrap.dedent(f"""
+    return textwrap.dedent(f"""
     <div class='mcard'>
       <div class='mcard-title'>{emoji} {w['city']}, {w['country']}</div>
       <div class='mcard-sub'>{w['desc']}</div>
@@ -683,10 +1936,61 @@ def render_weather_card(w):
         🌅 SUNRISE {w['sunrise']} &nbsp;·&nbsp; 🌇 SUNSET {w['sunset']}
       </div>
       <div style='font-family:Space Mono,monospace;font-size:.44rem;
-                  color:{T['text_dimmer']};margin-top:12px;'>
+                  color:var(--text-dimmer);margin-top:12px;'>
         SOURCE: wttr.in · LIVE · NO API KEY
       </div>
-    </div>"""), unsafe_allow_html=True)
+    </div>""")
+
+def render_image_grid(imgs, query=""):
+    st.markdown(image_grid_html(imgs, query), unsafe_allow_html=True)
+
+def render_yt_cards(videos):
+    st.markdown(yt_cards_html(videos), unsafe_allow_html=True)
+
+def render_weather_card(w):
+    st.markdown(weather_card_html(w), unsafe_allow_html=True)
+
+def media_entry(media_type, media_data):
+    """The media record a chat reply carries for one tool result."""
+    if media_type == "images":
+        return {"type": "images", "imgs": media_data["imgs"], "query": media_data.get("query","")}
+    if media_type == "youtube":
+        return {"type": "youtube", "videos": media_data["videos"], "query": media_data.get("query","")}
+    if media_type == "weather_card":
+        return {"type": "weather_card", "data": media_data}
+    if media_type == "multi":
+        return {"type": "multi", "items": media_data}
+    return None
+
+def media_html(media):
+    mtype = media.get("type")
+    if mtype == "images":
+        return image_grid_html(media["imgs"], media.get("query",""))
+    if mtype == "youtube":
+        return yt_cards_html(media["videos"])
+    if mtype == "weather_card":
+        return weather_card_html(media["data"])
+    if mtype == "multi":
+        return "".join(media_html(m) for m in media["items"])
+    return ""
+
+def render_media(media):
+    st.markdown(media_html(media), unsafe_allow_html=True)
+
+# Chat history is windowed: only the last `chat_window` messages are rendered,
+# and each one's markup is built once and kept in session state by message id.
+CHAT_WINDOW = 12
+
+def history_fragment(msg):
+    """(markdown, media html) for one stored message; cached once it has an id."""
+    cache, key = st.session_state.chat_html, msg.get("id")
+    if key in cache:
+        return cache[key]
+    media = msg.get("media")
+    frag = (msg["content"], media_html(media) if media else "")
+    if key:
+        cache[key] = frag
+    return frag
 
 def mic_button(btn_id="iris-mic-main", is_chat=False):
     cls = "mic-area" if is_chat else "mic-area form-mic"
@@ -831,215 +2135,494 @@ INTENTS = [
     ("open",       r'\b(open|launch|start|run)\b'),
 ]
 
-def detect_intent(text):
+# Single-pass classifier. Every INTENTS alternative that is a plain word or
+# phrase goes into a token table (WORD_INTENT / PHRASE_INTENT); the few real
+# regexes ("what does .+ mean", arithmetic, "say .+ in ") are combined into
+# one pattern with a named group per intent. One scan over the prompt's words
+# finds the highest-priority intent; the residual pattern runs only if it
+# could still beat what the words found. Same answer as trying INTENTS in
+# order, without rescanning the prompt up to nine times.
+TOKEN_RE    = re.compile(r'\w+')
+INTENT_RANK = {name: i for i, (name, _) in enumerate(INTENTS)}
+
+def _alternatives(pattern):
+    """Top-level alternatives of a r'\b(a|b|...)\b' pattern."""
+    body, alts, depth, cur = pattern[3:-3], [], 0, ""
+    for ch in body:
+        depth += (ch == "(") - (ch == ")")
+        if ch == "|" and depth == 0:
+            alts.append(cur); cur = ""
+        else:
+            cur += ch
+    return alts + [cur]
+
+def _build_classifier(intents):
+    words, phrases, rest = {}, {}, {}
+    for name, pat in intents:
+        for alt in _alternatives(pat):
+            plain = alt[:-2] if alt.endswith(r'\b') else alt
+            if re.fullmatch(r'[a-z]+(?: [a-z]+)*', plain):
+                toks = plain.split()
+                if len(toks) == 1:
+                    words.setdefault(toks[0], name)  # earlier intent wins
+                else:
+                    phrases.setdefault(toks[0], []).append((toks, name))
+            else:
+                rest.setdefault(name, []).append(alt)
+    residual = re.compile(r'\b(?=(?:' + "|".join(
+        f"(?P<{name}>(?:{'|'.join(alts)})\\b)" for name, alts in rest.items()) + '))', re.I)
+    return words, phrases, residual, min(INTENT_RANK[n] for n in rest)
+
+WORD_INTENT, PHRASE_INTENT, RESIDUAL_RE, RESIDUAL_MIN_RANK = _build_classifier(INTENTS)
+
+def _scan_intent(text):
+    """(intent, span) of the highest-priority match, or (None, None)."""
     t = text.lower()
-    for intent, pattern in INTENTS:
-        if re.search(pattern, t, re.I):
-            return intent
-    return "chat"
+    toks = list(TOKEN_RE.finditer(t))
+    best, span = None, None
+    for i, m in enumerate(toks):
+        w = m.group()
+        hits = [(WORD_INTENT[w], m.span())] if w in WORD_INTENT else []
+        for words, name in PHRASE_INTENT.get(w, ()):
+            j = i + len(words)
+            if j <= len(toks) and [x.group() for x in toks[i:j]] == words \
+                    and all(t[toks[k].end():toks[k + 1].start()] == " " for k in range(i, j - 1)):
+                hits.append((name, (m.start(), toks[j - 1].end())))
+        for name, sp in hits:
+            if best is None or INTENT_RANK[name] < INTENT_RANK[best]:
+                best, span = name, sp
+        if best is not None and INTENT_RANK[best] == 0:
+            return best, span
+    if best is None or INTENT_RANK[best] > RESIDUAL_MIN_RANK:
+        for m in RESIDUAL_RE.finditer(t):
+            name = m.lastgroup
+            if best is None or INTENT_RANK[name] < INTENT_RANK[best]:
+                best, span = name, m.span(name)
+    return best, span
+
+# Words dropped from the prompt to get each tool's query
+QUERY_STRIP = {
+    "image":      ["image","images","photo","photos","picture","pictures",
+                   "show me","pic of","pics of","find","search","get"],
+    "youtube":    ["play","youtube","video","videos","music","song",
+                   "watch","stream","yt","me","some","a"],
+    "search":     ["search","google","find","look up","tell me about",
+                   "what is","who is","news","latest"],
+    "dictionary": ["define","definition","meaning"],
+    "open":       ["open", "launch", "start", "run", "file", "this", "the"],
+}
 
-def extract_city(prompt):
-    # try "weather in X", "X weather", "X ka mausam"
-    for pat in [
-        r'weather\s+(?:in|at|for|of)\s+([A-Za-z][A-Za-z\s]{1,30}?)(?:\?|$|\.|\s+today|\s+now)',
-        r'([A-Za-z][A-Za-z\s]{1,20}?)\s+weather',
-        r'temperature\s+(?:in|at|of)\s+([A-Za-z][A-Za-z\s]{1,30}?)(?:\?|$|\.)',
-        r'forecast\s+(?:for|in)\s+([A-Za-z][A-Za-z\s]{1,30}?)(?:\?|$|\.)',
-    ]:
-        m = re.search(pat, prompt, re.I)
+# try "weather in X", "X weather", "X ka mausam"
+CITY_RES = [re.compile(p, re.I) for p in [
+    r'weather\s+(?:in|at|for|of)\s+([A-Za-z][A-Za-z\s]{1,30}?)(?:\?|$|\.|\s+today|\s+now)',
+    r'([A-Za-z][A-Za-z\s]{1,20}?)\s+weather',
+    r'temperature\s+(?:in|at|of)\s+([A-Za-z][A-Za-z\s]{1,30}?)(?:\?|$|\.)',
+    r'forecast\s+(?:for|in)\s+([A-Za-z][A-Za-z\s]{1,30}?)(?:\?|$|\.)',
+]]
+IMPERIAL_RE = re.compile(r'\bfahrenheit\b|\b°f\b', re.I)
+DEFINE_RE   = re.compile(r'(?:define|definition|meaning of|what does)\s+["\']?(\w+)', re.I)
+
+class IntentMatch(NamedTuple):
+    intent: str
+    span: Optional[tuple]   # where the intent keyword matched
+    city: Optional[str] = None
+    unit: Optional[str] = None
+    query: Optional[str] = None
+    word: Optional[str] = None
+
+@functools.lru_cache(maxsize=1024)
+def classify(prompt):
+    """Intent, matched span and the entities its tool needs, in one call.
+    Cached, so the planner and the tool share one classification."""
+    best, span = _scan_intent(prompt)
+    intent = best or "chat"
+    if intent == "weather":
+        return IntentMatch(intent, span, city=extract_city(prompt),
+                           unit="imperial" if IMPERIAL_RE.search(prompt) else "metric")
+    if intent == "dictionary":
+        m = DEFINE_RE.search(prompt)
+        return IntentMatch(intent, span, word=m.group(1) if m else extract_query(prompt, QUERY_STRIP[intent]))
+    if intent in QUERY_STRIP:
+        return IntentMatch(intent, span, query=extract_query(prompt, QUERY_STRIP[intent]) or prompt)
+    return IntentMatch(intent, span)
+
+def detect_intent(text):
+    return classify(text).intent
+
+def find_city(prompt):
+    for pat in CITY_RES:
+        m = pat.search(prompt)
         if m:
             city = m.group(1).strip().rstrip('?.,')
             if len(city) > 1:
                 return city
-    return "Mumbai"
+    return None
+
+def extract_city(prompt):
+    return find_city(prompt) or "Mumbai"
+
+@functools.lru_cache(maxsize=64)
+def _strip_re(words):
+    return re.compile(r'\b(?:' + "|".join(words) + r')\b', re.I)
 
 def extract_query(prompt, remove_words):
-    q = prompt
-    for w in remove_words:
-        q = re.sub(r'\b' + w + r'\b', '', q, flags=re.I)
+    q = _strip_re(tuple(remove_words)).sub('', prompt)
     return re.sub(r'\s+', ' ', q).strip(' ,?.')
 
-# ─── SMART INTENT HANDLER (runs inside chat) ──────────────────────────────────
-def handle_intent(prompt, text_placeholder):
-    """
-    Returns (text_response, media_type, media_data)
-    media_type: None | 'images' | 'youtube' | 'weather_card'
-    """
-    intent = detect_intent(prompt)
+# ─── SEARCH FAN-OUT ───────────────────────────────────────────────────────────
+SEARCH_SPECULATE_AFTER = 1.5  # s of CSE latency before the plain LLM answer races it
+
+def search_fanout(prompt, q, placeholder):
+    """Google results first, then a streamed summary under them. If CSE is slow
+    a plain LLM answer starts in parallel; whichever finishes first is shown."""
+    client = get_client()
+    search = submit(google_search, q, num=5)
+    fallback = None
+    try:
+        results, err = search.result(timeout=SEARCH_SPECULATE_AFTER)
+    except FutureTimeout:
+        placeholder.markdown(f"🔍 **{q}**\n\n_Searching…_")
+        if client:
+            msgs = llm_messages(prompt)
+            fallback = TokenStream(client, msgs, pick_model(prompt, msgs),
+                                   st.session_state.get("temperature", 0.7))
+            wait([search, fallback.future], return_when=FIRST_COMPLETED)
+        if search.done():
+            results, err = search.result()
+        else:
+            results, err = None, "search still running" # fallback finished first
 
-    # ── WEATHER ──────────────────────────────────────────────────────────────
+    if err or not results:
+        if not fallback:
+            return llm_stream(prompt, placeholder=placeholder)
+        try:
+            return stream_to(placeholder, fallback)
+        except Exception as e:
+            resp = f"⚠️ {e}"
+            placeholder.error(resp)
+            return resp
+    if fallback:
+        fallback.cancel()
+
+    links = "\n\n".join([f"**[{r['title']}]({r['link']})**\n{r['snippet']}" for r in results])
+    fmt = lambda summary: f"🔍 **{q}**\n\n{summary}\n\n---\n{links}"
+    placeholder.markdown(fmt("▌"))
+    if not client:
+        summary = "⚠️ No API key."
+    else:
+        snippets = "\n".join([r['snippet'] for r in results[:4]])
+        msgs = [{"role": "system", "content": "You are a helpful, concise assistant."},
+                {"role": "user", "content": f"Summarize in 2 concise sentences about '{q}':\n{snippets}"}]
+        gen = lambda: stream_to(placeholder, timed_chunks(client, msgs, MODEL_SMALL, 0.4), fmt)
+        try:
+            summary, hit = llm_cached(MODEL_SMALL, msgs[0]["content"], msgs[1]["content"], 0.4, gen)
+            if hit:
+                stream_to(placeholder, [summary], fmt)
+        except Exception as e:
+            summary = f"⚠️ {e}"
+    resp = fmt(summary)
+    if not tool_cancelled():
+        placeholder.markdown(resp)
+    return resp
+
+# ─── TOOL REGISTRY ────────────────────────────────────────────────────────────
+# Every intent is a tool: fn(prompt, placeholder) -> (text, media_type, media_data).
+# handle_intent plans one or more tool calls per prompt and runs them on an
+# asyncio loop, each on the tool pool under its own timeout and concurrency cap.
+TOOLS = {}
+_call = threading.local()
+
+def tool(intent, timeout=30, limit=8):
+    def deco(fn):
+        TOOLS[intent] = {"fn": fn, "timeout": timeout, "limit": limit}
+        return fn
+    return deco
+
+def tool_cancelled():
+    """True once the tool call running on this thread has timed out or been cancelled."""
+    ev = getattr(_call, "cancel", None)
+    return ev is not None and ev.is_set()
+
+@st.cache_resource
+def tool_pool():
+    return ThreadPoolExecutor(max_workers=32, thread_name_prefix="iris-tool")
+
+@st.cache_resource
+def tool_limits():
+    return {}
+
+def tool_semaphore(intent):
+    # process-wide, so the cap holds across every session, not just one turn
+    sems = tool_limits()
+    if intent not in sems:
+        sems.setdefault(intent, threading.BoundedSemaphore(TOOLS[intent]["limit"]))
+    return sems[intent]
+
+async def run_tool(intent, prompt, placeholder, speech=None):
+    spec, cancel, ctx = TOOLS[intent], threading.Event(), get_script_run_ctx()
+    trace = current_trace()
+    def work():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        bind_trace(trace)
+        sem = tool_semaphore(intent)
+        if not sem.acquire(timeout=spec["timeout"]):
+            raise TimeoutError(f"{intent} is busy, try again shortly")
+        _call.cancel, _call.speech, _call.intent = cancel, speech, intent
+        try:
+            with span(f"tool.{intent}"):
+                return spec["fn"](prompt, placeholder)
+        finally:
+            _call.cancel = _call.speech = _call.intent = None
+            bind_trace(None)
+            sem.release()
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(tool_pool(), work), spec["timeout"])
+    except asyncio.TimeoutError:
+        cancel.set()
+        resp = f"⏱ **{intent}** timed out after {spec['timeout']}s."
+    except asyncio.CancelledError:
+        cancel.set()
+        raise
+    except Exception as e:
+        resp = f"⚠️ {intent}: {e}"
+    placeholder.markdown(resp)
+    return resp, None, None
+
+MULTI_SPLIT = re.compile(r'\s*(?:,?\s+and then\s+|,?\s+and\s+|,?\s+then\s+|\s*;\s*)', re.I)
+MAX_TOOLS = 3
+
+def has_entity(intent, clause):
+    """Whether a clause names what its tool acts on (a city, a word, a query),
+    rather than being half of a phrase like "rock and roll"."""
     if intent == "weather":
-        city = extract_city(prompt)
-        unit = "imperial" if re.search(r'\bfahrenheit\b|\b°f\b', prompt, re.I) else "metric"
-        w, err = get_weather(city, unit)
-        if err:
-            resp = f"Couldn't get weather for **{city}**: {err}"
-            text_placeholder.markdown(resp)
-            return resp, None, None
-        desc_l = w['desc'].lower()
-        emoji = ("⛈" if "thunder" in desc_l else "🌧" if "rain" in desc_l else
-                 "🌦" if "drizzle" in desc_l else "❄️" if "snow" in desc_l else
-                 "🌫" if "fog" in desc_l or "mist" in desc_l else
-                 "🌤" if "cloud" in desc_l else "☀️")
-        resp = (f"{emoji} **Weather in {w['city']}, {w['country']}**\n\n"
-                f"**{w['temp']}** — {w['desc']}\n"
-                f"Feels like {w['feels']} · High {w['high']} / Low {w['low']}\n\n"
-                f"💧 Humidity {w['humidity']}% · 💨 Wind {w['wind']}\n"
-                f"👁 Visibility {w['visibility']} · 📊 {w['pressure']}\n"
-                f"☀️ UV {w['uv']} · 🌅 {w['sunrise']} / 🌇 {w['sunset']}")
+        return find_city(clause) is not None
+    if intent == "dictionary":
+        return DEFINE_RE.search(clause) is not None
+    if intent in QUERY_STRIP:
+        return bool(extract_query(clause, QUERY_STRIP[intent]))
+    return True
+
+def plan_intents(prompt):
+    """[(intent, sub_prompt)]. A prompt becomes several calls only when every
+    clause maps to a different tool and carries that tool's entity on its own
+    ("weather in Delhi and play lofi", not "play rock and roll music")."""
+    clauses = [c for c in MULTI_SPLIT.split(prompt) if c.strip()]
+    if 1 < len(clauses) <= MAX_TOOLS:
+        plan = [(detect_intent(c), c) for c in clauses]
+        intents = [i for i, _ in plan]
+        if "chat" not in intents and len(set(intents)) == len(intents) \
+                and all(has_entity(i, c) for i, c in plan):
+            return plan
+    return [(detect_intent(prompt), prompt)]
+
+async def run_plan(plan, placeholder, speech=None):
+    if len(plan) == 1:
+        return [await run_tool(*plan[0], placeholder, speech)]
+    box = placeholder.container()
+    slots = [box.empty() for _ in plan]
+    return await asyncio.gather(*[run_tool(i, p, ph) for (i, p), ph in zip(plan, slots)])
+
+# ─── TOOLS ────────────────────────────────────────────────────────────────────
+# ── WEATHER ──────────────────────────────────────────────────────────────
+@tool("weather", timeout=15)
+def weather_tool(prompt, text_placeholder):
+    m = classify(prompt)
+    city, unit = m.city, m.unit
+    w, err = get_weather(city, unit)
+    if err:
+        resp = f"Couldn't get weather for **{city}**: {err}"
         text_placeholder.markdown(resp)
-        return resp, "weather_card", w
-
-    # ── IMAGE SEARCH ─────────────────────────────────────────────────────────
-    elif intent == "image":
-        q = extract_query(prompt, ["image","images","photo","photos","picture","pictures",
-                                   "show me","pic of","pics of","find","search","get"])
-        if not q: q = prompt
-        imgs, err = google_image_search(q, num=6)
-        if err:
-            resp = f"Image search error: {err}"
-            text_placeholder.markdown(resp)
-            return resp, None, None
-        resp = f"🖼 Here are images for **{q}**:"
+        return resp, None, None
+    desc_l = w['desc'].lower()
+    emoji = ("⛈" if "thunder" in desc_l else "🌧" if "rain" in desc_l else
+             "🌦" if "drizzle" in desc_l else "❄️" if "snow" in desc_l else
+             "🌫" if "fog" in desc_l or "mist" in desc_l else
+             "🌤" if "cloud" in desc_l else "☀️")
+    resp = (f"{emoji} **Weather in {w['city']}, {w['country']}**\n\n"
+            f"**{w['temp']}** — {w['desc']}\n"
+            f"Feels like {w['feels']} · High {w['high']} / Low {w['low']}\n\n"
+            f"💧 Humidity {w['humidity']}% · 💨 Wind {w['wind']}\n"
+            f"👁 Visibility {w['visibility']} · 📊 {w['pressure']}\n"
+            f"☀️ UV {w['uv']} · 🌅 {w['sunrise']} / 🌇 {w['sunset']}")
+    text_placeholder.markdown(resp)
+    return resp, "weather_card", w
+
+# ── IMAGE SEARCH ─────────────────────────────────────────────────────────
+@tool("image", timeout=15)
+def image_tool(prompt, text_placeholder):
+    q = classify(prompt).query
+    imgs, err = google_image_search(q, num=6)
+    if err:
+        resp = f"Image search error: {err}"
         text_placeholder.markdown(resp)
-        return resp, "images", {"imgs": imgs, "query": q}
-
-    # ── YOUTUBE ──────────────────────────────────────────────────────────────
-    elif intent == "youtube":
-        q = extract_query(prompt, ["play","youtube","video","videos","music","song",
-                                   "watch","stream","yt","me","some","a"])
-        if not q: q = prompt
-        results, err = youtube_search(q, max_results=4)
-        if err:
-            fb_url = f"https://youtube.com/results?search_query={urllib.parse.quote(q)}"
-            resp = f"▶️ YouTube search for **{q}**\n\n[Open YouTube →]({fb_url})"
-            text_placeholder.markdown(resp)
-            return resp, None, None
-        resp = f"▶️ **YouTube results for: {q}**"
+        return resp, None, None
+    resp = f"🖼 Here are images for **{q}**:"
+    text_placeholder.markdown(resp)
+    return resp, "images", {"imgs": imgs, "query": q}
+
+# ── YOUTUBE ──────────────────────────────────────────────────────────────
+@tool("youtube", timeout=15)
+def youtube_tool(prompt, text_placeholder):
+    q = classify(prompt).query
+    results, err = youtube_search(q, max_results=4)
+    if err:
+        fb_url = f"https://youtube.com/results?search_query={urllib.parse.quote(q)}"
+        resp = f"▶️ YouTube search for **{q}**\n\n[Open YouTube →]({fb_url})"
         text_placeholder.markdown(resp)
-        return resp, "youtube", {"videos": results, "query": q}
-
-    # ── WEB SEARCH ───────────────────────────────────────────────────────────
-    elif intent == "search":
-        q = extract_query(prompt, ["search","google","find","look up","tell me about",
-                                   "what is","who is","news","latest"])
-        if not q: q = prompt
-        results, err = google_search(q, num=5)
-        if err or not results:
-            resp = llm_stream(prompt, placeholder=text_placeholder)
+        return resp, None, None
+    resp = f"▶️ **YouTube results for: {q}**"
+    text_placeholder.markdown(resp)
+    return resp, "youtube", {"videos": results, "query": q}
+
+# ── WEB SEARCH ───────────────────────────────────────────────────────────
+@tool("search", timeout=40)
+def search_tool(prompt, text_placeholder):
+    q = classify(prompt).query
+    resp = search_fanout(prompt, q, text_placeholder)
+    return resp, None, None
+
+# ── DICTIONARY ───────────────────────────────────────────────────────────
+@tool("dictionary", timeout=60)
+def dictionary_tool(prompt, text_placeholder):
+    word = classify(prompt).word
+    resp = llm_stream(
+        f"Define '{word}': 1) phonetics, 2) part of speech, 3) definition, 4) brief etymology, 5) 2 examples.",
+        system="You are a precise dictionary. Use clear formatting.",
+        placeholder=text_placeholder, include_history=False)
+    return resp, None, None
+
+# ── CALCULATOR ───────────────────────────────────────────────────────────
+@tool("calculate", timeout=60)
+def calculate_tool(prompt, text_placeholder):
+    m = re.search(r'[\d\.\+\-\*\/\^\(\)\s]+', prompt)
+    if m:
+        try:
+            import math as _m
+            safe = m.group().strip().replace("^","**")
+            val = eval(safe, {"__builtins__":{},"sqrt":_m.sqrt,"pi":_m.pi,"e":_m.e})
+            resp = f"🧮 **Result:** `{val}`\n\n*{m.group().strip()}*"
+            text_placeholder.markdown(resp)
             return resp, None, None
-        snippets = "\n".join([r['snippet'] for r in results[:4]])
-        summary = llm_quick(f"Summarize in 2 concise sentences about '{q}':\n{snippets}")
-        links = "\n\n".join([f"**[{r['title']}]({r['link']})**\n{r['snippet']}" for r in results])
-        resp = f"🔍 **{q}**\n\n{summary}\n\n---\n{links}"
+        except: pass
+    resp = llm_stream(f"Solve step by step: {prompt}",
+                      system="You are a precise math solver. Show all steps.",
+                      placeholder=text_placeholder, include_history=False)
+    return resp, None, None
+
+# ── TRANSLATE ────────────────────────────────────────────────────────────
+@tool("translate", timeout=60)
+def translate_tool(prompt, text_placeholder):
+    resp = llm_stream(
+        prompt + "\n\nGive only the translation. If non-Latin script, add romanized pronunciation below.",
+        system="You are a professional multilingual translator.",
+        placeholder=text_placeholder)
+    return resp, None, None
+
+# ── HEALTH ───────────────────────────────────────────────────────────────
+@tool("health", timeout=60)
+def health_tool(prompt, text_placeholder):
+    resp = llm_stream(prompt,
+        system="You are a health information assistant. Give accurate general info. "
+               "Always recommend consulting a doctor. Be concise and structured.",
+        placeholder=text_placeholder)
+    return resp, None, None
+
+# ── OPEN FILE ────────────────────────────────────────────────────────────
+@tool("open", timeout=20)
+def open_tool(prompt, text_placeholder):
+    import sys
+    if sys.platform != "win32":
+        resp = "⚠️ **Local File Access Disabled:** I am currently running in a cloud environment (Streamlit Cloud). I do not have access to the local files, folders, or applications on your computer."
         text_placeholder.markdown(resp)
         return resp, None, None
 
-    # ── DICTIONARY ───────────────────────────────────────────────────────────
-    elif intent == "dictionary":
-        m = re.search(r'(?:define|definition|meaning of|what does)\s+["\']?(\w+)', prompt, re.I)
-        word = m.group(1) if m else extract_query(prompt, ["define","definition","meaning"])
-        resp = llm_stream(
-            f"Define '{word}': 1) phonetics, 2) part of speech, 3) definition, 4) brief etymology, 5) 2 examples.",
-            system="You are a precise dictionary. Use clear formatting.",
-            placeholder=text_placeholder, include_history=False)
-        return resp, None, None
-
-    # ── CALCULATOR ───────────────────────────────────────────────────────────
-    elif intent == "calculate":
-        m = re.search(r'[\d\.\+\-\*\/\^\(\)\s]+', prompt)
-        if m:
-            try:
-                import math as _m
-                safe = m.group().strip().replace("^","**")
-                val = eval(safe, {"__builtins__":{},"sqrt":_m.sqrt,"pi":_m.pi,"e":_m.e})
-                resp = f"🧮 **Result:** `{val}`\n\n*{m.group().strip()}*"
-                text_placeholder.markdown(resp)
-                return resp, None, None
-            except: pass
-        resp = llm_stream(f"Solve step by step: {prompt}",
-                          system="You are a precise math solver. Show all steps.",
-                          placeholder=text_placeholder, include_history=False)
-        return resp, None, None
-
-    # ── TRANSLATE ────────────────────────────────────────────────────────────
-    elif intent == "translate":
-        resp = llm_stream(
-            prompt + "\n\nGive only the translation. If non-Latin script, add romanized pronunciation below.",
-            system="You are a professional multilingual translator.",
-            placeholder=text_placeholder)
-        return resp, None, None
-
-    # ── HEALTH ───────────────────────────────────────────────────────────────
-    elif intent == "health":
-        resp = llm_stream(prompt,
-            system="You are a health information assistant. Give accurate general info. "
-                   "Always recommend consulting a doctor. Be concise and structured.",
-            placeholder=text_placeholder)
-        return resp, None, None
-
-    # ── OPEN FILE ────────────────────────────────────────────────────────────
-    elif intent == "open":
-        import sys
-        if sys.platform != "win32":
-            resp = "⚠️ **Local File Access Disabled:** I am currently running in a cloud environment (Streamlit Cloud). I do not have access to the local files, folders, or applications on your computer."
+    filepath = classify(prompt).query.strip()
+    found = False
+    
+    # Try finding exactly the provided path
+    if os.path.exists(filepath) and os.path.isfile(filepath):
+        try:
+            os.startfile(filepath)
+            resp = f"📂 Opened file: **{filepath}**"
             text_placeholder.markdown(resp)
             return resp, None, None
-
-        q = extract_query(prompt, ["open", "launch", "start", "run", "file", "this", "the"])
-        if not q: q = prompt
-        filepath = q.strip()
-        found = False
-        
-        # Try finding exactly the provided path
-        if os.path.exists(filepath) and os.path.isfile(filepath):
-            try:
-                os.startfile(filepath)
-                resp = f"📂 Opened file: **{filepath}**"
-                text_placeholder.markdown(resp)
-                return resp, None, None
-            except Exception as e:
-                pass
-                
-        # Attempt heuristic search downward specifically across Downloads and Desktop
-        search_dirs = [
-            os.path.join(os.path.expanduser("~"), "Downloads"),
-            os.path.join(os.path.expanduser("~"), "Desktop")
-        ]
+        except Exception as e:
+            pass
+            
+    # Attempt heuristic search downward specifically across Downloads and Desktop
+    search_dirs = [
+        os.path.join(os.path.expanduser("~"), "Downloads"),
+        os.path.join(os.path.expanduser("~"), "Desktop")
+    ]
+    
+    for base_dir in search_dirs:
+        if found: break
+        if not os.path.exists(base_dir): continue
         
-        for base_dir in search_dirs:
+        for root, dirs, files in os.walk(base_dir):
+            if ".gemini" in root or "venv" in root or ".git" in root or "__pycache__" in root: continue
+            for file in files:
+                if file.lower() == filepath.lower() or filepath.lower() in file.lower():
+                    full_path = os.path.join(root, file)
+                    try:
+                        os.startfile(full_path)
+                        resp = f"📂 Opened: **{file}**"
+                        text_placeholder.markdown(resp)
+                        found = True
+                        break
+                    except Exception as e:
+                        pass
             if found: break
-            if not os.path.exists(base_dir): continue
-            
-            for root, dirs, files in os.walk(base_dir):
-                if ".gemini" in root or "venv" in root or ".git" in root or "__pycache__" in root: continue
-                for file in files:
-                    if file.lower() == filepath.lower() or filepath.lower() in file.lower():
-                        full_path = os.path.join(root, file)
-                        try:
-                            os.startfile(full_path)
-                            resp = f"📂 Opened: **{file}**"
-                            text_placeholder.markdown(resp)
-                            found = True
-                            break
-                        except Exception as e:
-                            pass
-                if found: break
-            
-        if not found:
-            resp = f"Could not find a file matching **{filepath}**."
-            text_placeholder.markdown(resp)
-        return resp, None, None
+        
+    if not found:
+        resp = f"Could not find a file matching **{filepath}**."
+        text_placeholder.markdown(resp)
+    return resp, None, None
 
-    # ── DEFAULT CHAT ─────────────────────────────────────────────────────────
-    else:
-        resp = llm_stream(prompt, placeholder=text_placeholder)
-        return resp, None, None
+# ── DEFAULT CHAT ─────────────────────────────────────────────────────────
+@tool("chat", timeout=60)
+def chat_tool(prompt, text_placeholder):
+    resp = llm_stream(prompt, placeholder=text_placeholder)
+    return resp, None, None
+
+# ─── SMART INTENT HANDLER (runs inside chat) ──────────────────────────────────
+def handle_intent(prompt, text_placeholder, speech=None):
+    """
+    Returns (text_response, media_type, media_data)
+    media_type: None | 'images' | 'youtube' | 'weather_card' | 'multi'
+    ('multi' carries a list of media entries, one per tool that returned media)
+    A SpeechPipeline passed as `speech` is fed the streamed text of a single-tool reply.
+    """
+    with span("intent") as sp:
+        plan = plan_intents(prompt)
+        sp["plan"] = ",".join(i for i, _ in plan)
+    results = asyncio.run(run_plan(plan, text_placeholder, speech))
+    if len(results) == 1:
+        return results[0]
+    text = "\n\n".join(r[0] for r in results)
+    media = [media_entry(t, d) for _, t, d in results if t]
+    return text, ("multi" if media else None), (media or None)
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # AUTH PAGE
 # ─────────────────────────────────────────────────────────────────────────────
+def start_session(email):
+    st.session_state.authenticated = True
+    st.session_state.user_email = email
+    st.session_state.messages = load_memory(email)
+
+if not st.session_state.authenticated and (tok := st.query_params.get("session")):
+    try:
+        email = check_session(tok)
+    except (sqlite3.Error, ValueError):
+        email = None
+    if email:
+        start_session(email)
+    else:
+        del st.query_params["session"]
+
 if not st.session_state.authenticated:
     _, mid, _ = st.columns([1, 1.1, 1])
     with mid:
@@ -1058,11 +2641,13 @@ if not st.session_state.authenticated:
                 em = st.text_input("Email", placeholder="you@domain.io")
                 pw = st.text_input("Password", type="password")
                 if st.form_submit_button("INITIALIZE SESSION"):
-                    u = load_users()
-                    if em in u and u[em] == hash_pw(pw):
-                        st.session_state.authenticated = True
-                        st.session_state.user_email = em
-                        st.session_state.messages = load_memory(em)
+                    try:
+                        ok = authenticate(em, pw)
+                    except (sqlite3.Error, ValueError):
+                        st.error("USER DATABASE UNREADABLE — CONTACT ADMIN"); st.stop()
+                    if ok:
+                        start_session(em)
+                        st.query_params["session"] = sign_session(em)
                         st.success("AUTHENTICATED")
                         st.rerun()
                     else:
@@ -1076,11 +2661,12 @@ if not st.session_state.authenticated:
                     if np_ != cp:      st.error("PASSWORDS DO NOT MATCH")
                     elif len(np_) < 6: st.error("MINIMUM 6 CHARACTERS")
                     else:
-                        u = load_users()
-                        if ne in u: st.error("IDENTITY ALREADY EXISTS")
-                        else:
-                            u[ne] = hash_pw(np_); save_users(u)
-                            st.success("CREATED — PLEASE LOGIN")
+                        try:
+                            created = create_user(ne, np_)
+                        except (sqlite3.Error, ValueError):
+                            st.error("USER DATABASE UNREADABLE — CONTACT ADMIN"); st.stop()
+                        if not created: st.error("IDENTITY ALREADY EXISTS")
+                        else: st.success("CREATED — PLEASE LOGIN")
     st.stop()
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -1118,8 +2704,22 @@ with st.sidebar:
         if st.button(f"{icon}  {label}", key=f"nav_{key}"):
             st.session_state.active_module = key; st.rerun()
 
+    st.markdown("<div class='sec-label'>History</div>", unsafe_allow_html=True)
+    hq = st.text_input("Search history", placeholder="Search past chats…", key="history_q",
+                       label_visibility="collapsed")
+    if hq.strip():
+        t0 = time.perf_counter()
+        # this runs on every rerun while the box has text; the flusher catches up on its own
+        hits = get_store().search(st.session_state.user_email, hq, prefix=True, fresh=False)
+        took = (time.perf_counter() - t0) * 1000
+        for h in hits:
+            when = datetime.datetime.fromtimestamp(h["ts"]).strftime("%d %b %H:%M")
+            sn = strip_boilerplate(h["snippet"]).replace("\x02", "**").replace("\x03", "**")
+            st.caption(f"{'YOU' if h['role'] == 'user' else 'IRIS'} · {when} — {sn}")
+        st.caption(f"{len(hits) or 'NO'} MATCH{'' if len(hits) == 1 else 'ES'} · {took:.1f} MS")
+
     st.markdown("<div class='sec-label'>Settings</div>", unsafe_allow_html=True)
-    st.session_state["model"] = "llama-3.3-70b-versatile"
+    st.session_state.setdefault("model", "auto")  # set to a model id to pin every call to it
     st.session_state["temperature"] = 0.7
 
     tc1, tc2 = st.columns([1.6, 1])
@@ -1130,6 +2730,12 @@ with st.sidebar:
                 "JA":"ja","AR":"ar","ZH":"zh","TA":"ta","TE":"te","MR":"mr"}
         sel = st.selectbox("TTS Lang", list(lmap.keys()))
         st.session_state.tts_lang = lmap[sel]
+    ms = model_stats().snapshot()
+    if ms:
+        st.caption("ROUTER · " + " · ".join(
+            f"{'8B' if m == MODEL_SMALL else '70B' if m == MODEL_LARGE else m} "
+            f"{v['calls']}× p50 {v['p50']}s" + (f" ↑{v['escalated']}" if v['escalated'] else "")
+            for m, v in ms.items()))
 
     st.markdown("<div class='sec-label'>THEME</div>", unsafe_allow_html=True)
     tcols = st.columns(5)
@@ -1149,15 +2755,20 @@ with st.sidebar:
     cc1, cc2 = st.columns(2)
     with cc1:
         if st.button("RESET"):
-            st.session_state.messages = []; st.session_state.chat_media = {}
+            st.session_state.messages = []
+            st.session_state.chat_html = {}; st.session_state.chat_window = None
             save_memory(st.session_state.user_email, []); st.rerun()
     with cc2:
         if st.button("LOGOUT"):
             save_memory(st.session_state.user_email, st.session_state.messages)
+            get_store().flush()
+            get_users().revoke_sessions(st.session_state.user_email)
             st.session_state.authenticated = False
             st.session_state.user_email = None
             st.session_state.messages = []
-            st.session_state.chat_media = {}
+            st.session_state.chat_html = {}
+            st.session_state.chat_window = None
+            st.query_params.pop("session", None)
             st.rerun()
 
     st.markdown(f"""
@@ -1179,6 +2790,20 @@ def page_header(title, sub=""):
       <div class='page-rule'></div>
     </div>""", unsafe_allow_html=True)
 
+def debug_panel():
+    """Latency breakdown of this session's last turns (shown with ?debug=1)."""
+    traces = st.session_state.traces
+    with st.expander("◈ DEBUG · TURN TRACE", expanded=True):
+        if not traces:
+            st.caption("NO TRACED TURNS YET")
+            return
+        t = traces[-1]
+        st.caption(f"LAST TURN {t['ms']} MS · {len(t['spans'])} SPANS · TRACE {t['trace'][:8]}")
+        st.dataframe(t["spans"], hide_index=True)
+        st.caption("RECENT TURNS · " + " · ".join(f"{x['ms']:.0f}" for x in traces[-10:]) + " MS")
+        st.json({"caches": cache_stats(), "memory": get_store().stats(), "models": model_stats().snapshot(),
+                 "admission": {n: p.stats() for n, p in providers().items()}}, expanded=False)
+
 mod = st.session_state.active_module
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -1216,20 +2841,20 @@ if mod == "chat":
           <div style='display:flex;flex-wrap:wrap;gap:7px;justify-content:center;'>{chips}</div>
         </div>""", unsafe_allow_html=True)
 
-    # Render message history + associated media
-    for idx, msg in enumerate(st.session_state.messages):
-        with st.chat_message(msg["role"]):
-            st.markdown(msg["content"])
-            # Re-render media attached to this message
-            media = st.session_state.chat_media.get(idx)
+    # Render the visible window of history + associated media
+    msgs = st.session_state.messages
+    window = st.session_state.chat_window or CHAT_WINDOW
+    start = max(0, len(msgs) - window)
+    if start:
+        if st.button(f"▲ LOAD EARLIER · {start} MORE", key="chat_earlier"):
+            st.session_state.chat_window = window + CHAT_WINDOW
+            st.rerun()
+    for idx in range(start, len(msgs)):
+        text, media = history_fragment(msgs[idx])
+        with st.chat_message(msgs[idx]["role"]):
+            st.markdown(text)
             if media:
-                mtype = media.get("type")
-                if mtype == "images":
-                    render_image_grid(media["imgs"], media.get("query",""))
-                elif mtype == "youtube":
-                    render_yt_cards(media["videos"])
-                elif mtype == "weather_card":
-                    render_weather_card(media["data"])
+                st.markdown(media, unsafe_allow_html=True)
 
     st.markdown("</div>", unsafe_allow_html=True)
 
@@ -1238,46 +2863,51 @@ if mod == "chat":
 
     # Chat input
     if prompt := st.chat_input("Ask IRIS — weather, images, YouTube, search, translate…"):
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-
-        with st.chat_message("assistant"):
-            ph = st.empty()
-            try:
-                text_resp, media_type, media_data = handle_intent(prompt, ph)
-
-                # Render media inline right after the text
-                if media_type == "images":
-                    render_image_grid(media_data["imgs"], media_data.get("query",""))
-                elif media_type == "youtube":
-                    render_yt_cards(media_data["videos"])
-                elif media_type == "weather_card":
-                    render_weather_card(media_data)
-
-                # Save message + attach media reference by index
-                msg_idx = len(st.session_state.messages)
-                st.session_state.messages.append({"role": "assistant", "content": text_resp})
-
-                if media_type == "images":
-                    st.session_state.chat_media[msg_idx] = {
-                        "type": "images", "imgs": media_data["imgs"],
-                        "query": media_data.get("query","")}
-                elif media_type == "youtube":
-                    st.session_state.chat_media[msg_idx] = {
-                        "type": "youtube", "videos": media_data["videos"],
-                        "query": media_data.get("query","")}
-                elif media_type == "weather_card":
-                    st.session_state.chat_media[msg_idx] = {
-                        "type": "weather_card", "data": media_data}
-
-                save_memory(st.session_state.user_email, st.session_state.messages)
+        trace = Trace("chat.turn", prompt_chars=len(prompt))
+        bind_trace(trace)
+        try:
+            st.session_state.messages.append({"role": "user", "content": prompt})
+            with st.chat_message("user"):
+                st.markdown(prompt)
+
+            with st.chat_message("assistant"):
+                ph = st.empty()
+                speech = None
+                if st.session_state.tts_enabled:
+                    speech = SpeechPipeline(st.session_state.tts_lang, st.container(key="iris_speech"))
+                    speech_player()
+                try:
+                    text_resp, media_type, media_data = handle_intent(prompt, ph, speech)
+
+                    # Render media inline right after the text
+                    media = media_entry(media_type, media_data)
+                    if media:
+                        render_media(media)
+
+                    # Save the reply with its media; both are persisted on the same row
+                    reply = {"role": "assistant", "content": text_resp}
+                    if media:
+                        reply["media"] = media
+                    st.session_state.messages.append(reply)
+
+                    with span("save_memory"):
+                        save_memory(st.session_state.user_email, st.session_state.messages)
+
+                    # gTTS speak — streamed replies were already queued sentence by sentence
+                    with span("speech"):
+                        if speech and speech.fed:
+                            speech.finish()
+                        else:
+                            speak(text_resp, lang=st.session_state.tts_lang)
 
-                # gTTS speak
-                speak(text_resp, lang=st.session_state.tts_lang)
+                except Exception as e:
+                    ph.error(f"ERROR — {e}")
+        finally:
+            bind_trace(None)
+            st.session_state.traces = (st.session_state.traces + [trace.finish()])[-TRACE_KEEP:]
 
-            except Exception as e:
-                ph.error(f"ERROR — {e}")
+    if st.query_params.get("debug") == "1":
+        debug_panel()
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -1311,6 +2941,8 @@ elif mod == "search":
                               color:{T["text_dimmer"]};margin-bottom:5px;'>{r["link"][:65]}…</div>
                   <div class='result-text'>{r["snippet"]}</div>
                 </div>""", unsafe_allow_html=True)
+    ac = cache_stats()["api"]
+    st.caption(f"CACHE · {ac['hits']} HIT / {ac['stale']} STALE / {ac['misses']} MISS")
     st.markdown("</div>", unsafe_allow_html=True)
 
 elif mod == "images":
@@ -1370,6 +3002,9 @@ elif mod == "weather":
             render_weather_card(w)
             speak(f"Weather in {w['city']}: {w['desc']}, {w['temp']}. Feels like {w['feels']}.",
                   lang=st.session_state.tts_lang)
+    cs = cache_stats()
+    st.caption("CACHE · " + " · ".join(
+        f"{n.upper()} {cs[n]['hits']} HIT / {cs[n]['misses']} MISS" for n in ("geocode", "forecast")))
     st.markdown("</div>", unsafe_allow_html=True)
 
 elif mod == "dictionary":
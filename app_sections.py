@@ -0,0 +1,22 @@
+"""Load parts of app.py without running the Streamlit page.
+
+app.py is a Streamlit script, so importing it would render the UI. Tools
+that only need self-contained pieces (the benchmarks, scripts/users.py)
+execute the script's top-level imports plus the named `# ─── SECTION ───`
+blocks instead.
+"""
+import ast, os
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(ROOT, "app.py")
+
+def load_sections(*names):
+    src = open(APP, encoding="utf-8").read()
+    ns = {"__name__": "iris_app", "__file__": APP}
+    imports = [n for n in ast.parse(src).body if isinstance(n, (ast.Import, ast.ImportFrom))]
+    exec(compile(ast.Module(body=imports, type_ignores=[]), APP, "exec"), ns)
+    for name in names:
+        start = src.index(f"# ─── {name} ")
+        end = src.find("\n# ─── ", start + 1)
+        exec(compile("\n" * src.count("\n", 0, start) + src[start:end], APP, "exec"), ns)
+    return ns
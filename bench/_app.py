@@ -0,0 +1,9 @@
+"""Shared helpers for the benchmarks: the app.py section loader and the prompt corpus."""
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app_sections import ROOT, APP, load_sections  # noqa: E402
+
+def read_prompts(path=os.path.join(os.path.dirname(__file__), "prompts.txt")):
+    with open(path, encoding="utf-8") as f:
+        return [l.strip() for l in f if l.strip() and not l.startswith("#")]
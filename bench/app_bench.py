@@ -0,0 +1,166 @@
+"""End-to-end benchmark: the prompt corpus through a real chat turn, offline.
+
+Starts the local API stand-ins (bench/stubs.py), points app.py at them and
+replays bench/prompts.txt through the chat page with Streamlit's AppTest,
+so every turn runs the real handle_intent, tools, caches, HTTP pool and
+LLM streaming. Timings come from each turn's trace. Reports, per intent:
+p50/p95 turn latency on the first (cold cache) round and on later (warm)
+rounds, plus the cold time inside handle_intent; overall throughput; p50
+per stage; and peak memory per turn above a plain rerun (tracemalloc,
+separate cold pass). Then micro-benchmarks classify, detect_intent,
+extract_city and the render helpers on the media the turns produced.
+
+    python bench/app_bench.py [--rounds 3] [--latency 80] [--ttft 250] [--token-ms 15]
+"""
+import argparse, logging, os, shutil, statistics, sys, tempfile, time, timeit, tracemalloc, warnings
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(__file__))
+warnings.filterwarnings("ignore")
+logging.disable(logging.WARNING)
+from _app import ROOT, APP, load_sections, read_prompts
+from stubs import Stubs
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))] if xs else float("nan")
+
+class Session:
+    """One signed-in chat session on the real app, driven by AppTest."""
+    def __init__(self):
+        from streamlit.testing.v1 import AppTest
+        self.at = AppTest.from_file(APP, default_timeout=60)
+        self.at.session_state.authenticated = True
+        self.at.session_state.user_email = "bench@iris.local"
+        self.at.session_state.tts_enabled = False
+        self.at.run()
+        assert not self.at.exception, self.at.exception
+
+    def turn(self, prompt):
+        """Run one prompt on a fresh conversation; returns (trace record, media)."""
+        at = self.at
+        at.session_state.messages = []
+        at.chat_input[0].set_value(prompt).run()
+        assert not at.exception, at.exception
+        return at.session_state.traces[-1], at.session_state.messages[-1].get("media")
+
+def summarize(rec):
+    spans = {s["name"]: s for s in rec["spans"]}
+    intent = spans.get("intent", {}).get("plan", "?")
+    start = spans["intent"]["start_ms"] if "intent" in spans else 0
+    end = spans["save_memory"]["start_ms"] if "save_memory" in spans else rec["ms"]
+    return intent, rec["ms"], end - start
+
+def table(title, rows, head):
+    print(f"\n{title}")
+    print("".join(f"{h:>{w}}" if i else f"{h:<{w}}" for i, (h, w) in enumerate(head)))
+    for row in rows:
+        print("".join(f"{v:>{w}}" if i else f"{v:<{w}}" for i, (v, (_, w)) in enumerate(zip(row, head))))
+
+def run_rounds(session, prompts, rounds):
+    turns, stages, media, wall = [], defaultdict(list), [], 0.0
+    for r in range(rounds):
+        t0 = time.perf_counter()
+        for p in prompts:
+            rec, m = session.turn(p)
+            intent, ms, handle = summarize(rec)
+            turns.append((r, intent, ms, handle))
+            for s in rec["spans"]:
+                stages[s["name"].split(" ")[0]].append(s["ms"])
+            if m and r == 0:
+                media.append(m)
+        wall += time.perf_counter() - t0
+    return turns, stages, media, wall
+
+def memory_pass(session, prompts):
+    """Peak traced allocation per turn above a plain rerun's, on a cold cache."""
+    import streamlit as st
+    st.cache_resource.clear()
+    for f in os.listdir("."):
+        if f.startswith("cache.db"):
+            os.remove(f)
+    peaks = defaultdict(list)
+    tracemalloc.start()
+    session.at.run()  # a plain rerun: script execution and page render alone
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    session.at.run()
+    rerun = tracemalloc.get_traced_memory()[1] - base
+    for p in prompts:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        rec, _ = session.turn(p)
+        peaks[summarize(rec)[0]].append((tracemalloc.get_traced_memory()[1] - base - rerun) / 1024)
+    tracemalloc.stop()
+    return peaks
+
+def micro(prompts, media, number):
+    ns = load_sections("INTENT DETECTION")
+    rh = load_sections("RENDER HELPERS")
+    rows = []
+    for name, fn, items in [("classify", ns["classify"], prompts),
+                            ("detect_intent", ns["detect_intent"], prompts),
+                            ("extract_city", ns["extract_city"], prompts),
+                            ("media_html", rh["media_html"], media)]:
+        if not items:
+            continue
+        t = timeit.timeit(lambda: [fn(x) for x in items], number=number)
+        rows.append((name, len(items), f"{t / number / len(items) * 1e6:.1f}"))
+    for mtype in ("images", "youtube", "weather_card"):
+        items = [m for m in media if m["type"] == mtype]
+        if items:
+            t = timeit.timeit(lambda: [rh["media_html"](m) for m in items], number=number)
+            rows.append((f"  {mtype}", len(items), f"{t / number / len(items) * 1e6:.1f}"))
+    return rows
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--rounds", type=int, default=3, help="passes over the corpus (first is cold)")
+    ap.add_argument("--latency", type=float, default=80, help="ms per stubbed API response")
+    ap.add_argument("--ttft", type=float, default=250, help="ms before the first LLM chunk")
+    ap.add_argument("--token-ms", type=float, default=15, help="ms between LLM chunks")
+    ap.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    ap.add_argument("-n", "--number", type=int, default=200, help="micro-benchmark repetitions")
+    args = ap.parse_args()
+
+    stubs = Stubs(latency=args.latency / 1000, ttft=args.ttft / 1000, token=args.token_ms / 1000).start()
+    work = tempfile.mkdtemp(prefix="iris-bench-")
+    os.chdir(work)  # iris.db, cache.db and traces.jsonl stay out of the tree
+    shutil.copytree(os.path.join(ROOT, ".streamlit"), ".streamlit", dirs_exist_ok=True)
+    os.environ.update(stubs.env(), IRIS_TRACE_FILE=os.path.join(work, "traces.jsonl"))
+    try:
+        prompts = read_prompts()
+        session = Session()
+        turns, stages, media, wall = run_rounds(session, prompts, args.rounds)
+        print(f"{len(turns)} turns ({len(prompts)} prompts × {args.rounds} rounds) in {wall:.1f}s"
+              f" — {len(turns) / wall:.2f} turns/s;  stub latency {args.latency:g} ms,"
+              f" ttft {args.ttft:g} ms, {args.token_ms:g} ms/chunk")
+
+        by = defaultdict(lambda: ([], [], []))
+        for r, intent, ms, handle in turns:
+            cold, warm, h = by[intent]
+            (cold if r == 0 else warm).append(ms)
+            if r == 0:
+                h.append(handle)
+        peaks = {} if args.no_memory else memory_pass(session, prompts)
+        rows = [(i, len(c) + len(w), f"{pct(c, 50):.0f}", f"{pct(c, 95):.0f}",
+                 f"{pct(w, 50):.0f}", f"{pct(w, 95):.0f}", f"{pct(h, 50):.0f}",
+                 f"{max(0, pct(peaks[i], 50)):.0f}" if i in peaks else "-")
+                for i, (c, w, h) in sorted(by.items())]
+        table("turn latency by intent (ms)", rows,
+              [("intent", 22), ("n", 5), ("cold p50", 10), ("cold p95", 10),
+               ("warm p50", 10), ("warm p95", 10), ("handle p50", 12), ("peak KB", 9)])
+        table("stages (ms, all rounds)",
+              [(s, len(v), f"{pct(v, 50):.1f}", f"{pct(v, 95):.1f}") for s, v in
+               sorted(stages.items(), key=lambda kv: -statistics.fmean(kv[1]))],
+              [("stage", 22), ("n", 6), ("p50", 10), ("p95", 10)])
+        print("\nupstream calls:", ", ".join(f"{k} {v}" for k, v in sorted(stubs.calls.items())))
+        table("micro-benchmarks (µs per item)", micro(prompts, media, args.number),
+              [("function", 22), ("items", 6), ("µs", 10)])
+    finally:
+        stubs.stop()
+        os.chdir(ROOT)
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Per-rerun CSS payload: the old themed f-string vs. the static sheet.
+
+Before, every rerun re-formatted the whole stylesheet for the active theme
+and sent it inline through st.markdown. Now the sheet lives in
+static/iris.css and each rerun ships only the link tag plus the theme's
+:root custom properties. The legacy payload is rebuilt here by resolving
+the sheet's var() references against each theme, which is what the
+f-string used to produce.
+
+    python bench/css_payload.py
+"""
+import logging, os, re, sys, warnings
+
+sys.path.insert(0, os.path.dirname(__file__))
+warnings.filterwarnings("ignore")
+logging.disable(logging.WARNING)  # bare-mode "missing ScriptRunContext" noise
+import streamlit as st
+from _app import ROOT, load_sections
+
+os.chdir(ROOT)  # pick up .streamlit/config.toml (static serving)
+
+st.session_state.theme = "black"
+ns = load_sections("THEMES", "CSS")
+VAR = re.compile(r'var\(--([a-z0-9-]+)\)')
+
+def legacy_css(theme):
+    props = dict(re.findall(r'--([a-z0-9-]+):([^;}]+)', ns["theme_css"](theme)))
+    return "<style>\n" + VAR.sub(lambda m: props[m[1]], ns["css_sheet"]()) + "</style>\n"
+
+def main():
+    link = ns["stylesheet"]()
+    print(f"static sheet: {len(ns['css_sheet']().encode())} B, fetched once (link tag {len(link.encode())} B)\n")
+    print(f"{'theme':<8}{'legacy B':>10}{'now B':>8}{'saved':>8}")
+    for name in ns["THEMES"]:
+        old = len(legacy_css(name).encode())
+        new = len((link + ns["theme_css"](name)).encode())
+        print(f"{name:<8}{old:>10}{new:>8}{1 - new / old:>8.1%}")
+
+if __name__ == "__main__":
+    main()
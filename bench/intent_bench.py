@@ -0,0 +1,78 @@
+"""Micro-benchmark: per-prompt cost of intent classification.
+
+Compares the current single-pass classifier in app.py (classify /
+detect_intent + entity extraction) with the original implementation,
+which ran up to nine re.search calls and then rescanned the prompt for
+the city or query. Also checks both agree on every prompt in the corpus.
+
+    python bench/intent_bench.py [-n ROUNDS]
+"""
+import argparse, os, re, sys, timeit
+
+sys.path.insert(0, os.path.dirname(__file__))
+from _app import load_sections, read_prompts
+
+# ─── ORIGINAL IMPLEMENTATION (reference) ──────────────────────────────────────
+def legacy_detect_intent(text, INTENTS):
+    t = text.lower()
+    for intent, pattern in INTENTS:
+        if re.search(pattern, t, re.I):
+            return intent
+    return "chat"
+
+def legacy_extract_city(prompt):
+    for pat in [
+        r'weather\s+(?:in|at|for|of)\s+([A-Za-z][A-Za-z\s]{1,30}?)(?:\?|$|\.|\s+today|\s+now)',
+        r'([A-Za-z][A-Za-z\s]{1,20}?)\s+weather',
+        r'temperature\s+(?:in|at|of)\s+([A-Za-z][A-Za-z\s]{1,30}?)(?:\?|$|\.)',
+        r'forecast\s+(?:for|in)\s+([A-Za-z][A-Za-z\s]{1,30}?)(?:\?|$|\.)',
+    ]:
+        m = re.search(pat, prompt, re.I)
+        if m:
+            city = m.group(1).strip().rstrip('?.,')
+            if len(city) > 1:
+                return city
+    return "Mumbai"
+
+def legacy_extract_query(prompt, remove_words):
+    q = prompt
+    for w in remove_words:
+        q = re.sub(r'\b' + w + r'\b', '', q, flags=re.I)
+    return re.sub(r'\s+', ' ', q).strip(' ,?.')
+
+def legacy_classify(prompt, app):
+    intent = legacy_detect_intent(prompt, app["INTENTS"])
+    if intent == "weather":
+        return intent, legacy_extract_city(prompt)
+    if intent in app["QUERY_STRIP"] and intent != "dictionary":
+        return intent, legacy_extract_query(prompt, app["QUERY_STRIP"][intent]) or prompt
+    return intent, None
+
+def current_classify(prompt, app):
+    m = app["classify"].__wrapped__(prompt)  # bypass the memo: measure the real work
+    return m.intent, m.city if m.intent == "weather" else m.query
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-n", "--rounds", type=int, default=200)
+    args = ap.parse_args()
+
+    app = load_sections("INTENT DETECTION")
+    prompts = read_prompts()
+
+    mismatches = [(p, legacy_classify(p, app), current_classify(p, app)) for p in prompts
+                  if legacy_classify(p, app) != current_classify(p, app)]
+    for p, old, new in mismatches:
+        print(f"MISMATCH {p!r}: legacy={old} current={new}")
+
+    for name, fn in [("legacy", legacy_classify), ("current", current_classify)]:
+        t = timeit.timeit(lambda: [fn(p, app) for p in prompts], number=args.rounds)
+        print(f"{name:8s} {t / (args.rounds * len(prompts)) * 1e6:8.2f} µs/prompt")
+    memo = timeit.timeit(lambda: [app["classify"](p) for p in prompts], number=args.rounds)
+    print(f"{'memoised':8s} {memo / (args.rounds * len(prompts)) * 1e6:8.2f} µs/prompt "
+          f"(second lookup of the same prompt, as the tool does)")
+    print(f"{len(prompts)} prompts · {len(mismatches)} mismatches")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
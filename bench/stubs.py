@@ -0,0 +1,169 @@
+"""Local stand-ins for the upstream APIs IRIS calls.
+
+One threaded HTTP server answers for Groq (OpenAI-compatible chat
+completions, streamed or not), Google Custom Search (web and image),
+YouTube search and Open-Meteo (geocoding and forecast), using the recorded
+responses in bench/fixtures. Latency is configurable: a fixed delay per API
+response, plus time-to-first-token and per-chunk delays for LLM streams.
+
+    python bench/stubs.py [--port 8765] [--latency 80] [--ttft 250] [--token-ms 15]
+
+serves until Ctrl-C. To run the real UI offline against it, start the
+stubs in one terminal and the app in another:
+
+    python bench/stubs.py
+    env $(python bench/stubs.py --print-env) streamlit run app.py
+
+--print-env only prints the variables for --port; it does not bind it.
+"""
+import argparse, http.server, json, os, random, threading, time, urllib.parse
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return json.load(f)
+
+def stub_env(url):
+    """Environment that points app.py (and the Groq client) at stubs on `url`."""
+    return {"GROQ_BASE_URL": url, "IRIS_GOOGLE_API_BASE": url,
+            "IRIS_GEOCODE_API_BASE": url, "IRIS_FORECAST_API_BASE": url,
+            "GEMINI_API_KEY": "stub", "GOOGLE_API_KEY": "stub", "GOOGLE_CSE_ID": "stub",
+            "YOUTUBE_API_KEY": "stub"}
+
+def fill(obj, q):
+    """Replace the "{q}" placeholders in a fixture with the request's query."""
+    return json.loads(json.dumps(obj).replace("{q}", q.replace('"', "")))
+
+class Stubs:
+    def __init__(self, port=0, latency=0.08, ttft=0.25, token=0.015, jitter=0.2, seed=0):
+        self.latency, self.ttft, self.token, self.jitter = latency, ttft, token, jitter
+        self.fx = {n[:-5]: fixture(n) for n in os.listdir(FIXTURES) if n.endswith(".json")}
+        self.calls, self._rng, self._lock = {}, random.Random(seed), threading.Lock()
+        stubs = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *a):
+                pass
+            def do_GET(self):
+                stubs._get(self)
+            def do_POST(self):
+                stubs._post(self)
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def env(self):
+        return stub_env(self.url)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="iris-stubs", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def _sleep(self, seconds):
+        with self._lock:
+            j = self._rng.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(max(0.0, seconds * j))
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _send(self, h, status, body, ctype="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        h.send_response(status)
+        h.send_header("Content-Type", ctype)
+        h.send_header("Content-Length", str(len(data)))
+        h.end_headers()
+        h.wfile.write(data)
+
+    def _get(self, h):
+        url = urllib.parse.urlsplit(h.path)
+        qs = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == "/customsearch/v1":
+            name, body = ("images", "images") if qs.get("searchType") == "image" else ("search", "search")
+            body = fill(self.fx[body], qs.get("q", ""))
+            body["items"] = body["items"][:int(qs.get("num", 10))]
+        elif url.path == "/youtube/v3/search":
+            name, body = "youtube", fill(self.fx["youtube"], qs.get("q", ""))
+            body["items"] = body["items"][:int(qs.get("maxResults", 5))]
+        elif url.path == "/v1/search":
+            city = qs.get("name", "")
+            geo = self.fx["geocode"]
+            name, body = "geocode", {"results": [geo.get(city) or fill(geo["default"], city)]}
+        elif url.path == "/v1/forecast":
+            name, body = "forecast", self.fx["forecast"]
+        else:
+            return self._send(h, 404, {"error": {"message": f"no stub for {url.path}"}})
+        self._count(name)
+        self._sleep(self.latency)
+        self._send(h, 200, body)
+
+    def _post(self, h):
+        req = json.loads(h.rfile.read(int(h.headers.get("Content-Length", 0))) or b"{}")
+        if not h.path.endswith("/chat/completions"):
+            return self._send(h, 404, {"error": {"message": f"no stub for {h.path}"}})
+        self._count("llm")
+        with self._lock:
+            chunks = self._rng.choice(self.fx["llm"]["streams"])
+        usage = {"prompt_tokens": sum(len(m.get("content", "")) // 4 for m in req.get("messages", [])),
+                 "completion_tokens": len(chunks)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": req.get("model", "stub")}
+        if not req.get("stream"):
+            self._sleep(self.ttft + self.token * len(chunks))
+            return self._send(h, 200, {**base, "object": "chat.completion", "usage": usage, "choices": [
+                {"index": 0, "finish_reason": "stop",
+                 "message": {"role": "assistant", "content": "".join(chunks)}}]})
+        h.send_response(200)
+        h.send_header("Content-Type", "text/event-stream")
+        h.send_header("Transfer-Encoding", "chunked")
+        h.end_headers()
+        def event(obj):
+            data = b"data: " + (obj if isinstance(obj, bytes) else json.dumps(obj).encode()) + b"\n\n"
+            h.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            h.wfile.flush()
+        try:
+            self._sleep(self.ttft)
+            for i, c in enumerate(chunks):
+                if i:
+                    self._sleep(self.token)
+                event({**base, "object": "chat.completion.chunk", "choices": [
+                    {"index": 0, "delta": {"content": c}, "finish_reason": None}]})
+            event({**base, "object": "chat.completion.chunk", "x_groq": {"usage": usage},
+                   "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            event(b"[DONE]")
+            h.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client cancelled the stream
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency", type=float, default=80, help="ms per API response")
+    ap.add_argument("--ttft", type=float, default=250, help="ms before the first LLM chunk")
+    ap.add_argument("--token-ms", type=float, default=15, help="ms between LLM chunks")
+    ap.add_argument("--print-env", action="store_true",
+                    help="print the env for stubs on --port and exit (without serving)")
+    args = ap.parse_args()
+    if args.print_env:
+        print(" ".join(f"{k}={v}" for k, v in stub_env(f"http://127.0.0.1:{args.port}").items()))
+        return
+    stubs = Stubs(args.port, args.latency / 1000, args.ttft / 1000, args.token_ms / 1000)
+    print("\n".join(f"{k}={v}" for k, v in stubs.env().items()))
+    print(f"serving on {stubs.url} (Ctrl-C to stop)")
+    try:
+        stubs.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""Import or export IRIS accounts as users.json ({email: password hash}).
+
+    python scripts/users.py export users.json     # iris.db → file
+    python scripts/users.py import users.json     # file → iris.db, keeps existing accounts
+    python scripts/users.py import users.json --replace
+
+Run from the directory that holds iris.db (the app's working directory).
+Hashes are copied as they are; legacy SHA-256 entries are upgraded to scrypt
+on each user's next login.
+"""
+import argparse, logging, os, sys, warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+warnings.filterwarnings("ignore")
+logging.disable(logging.WARNING)  # bare-mode "missing ScriptRunContext" noise
+from app_sections import load_sections
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("action", choices=["import", "export"])
+    ap.add_argument("path")
+    ap.add_argument("--replace", action="store_true", help="on import, overwrite existing accounts")
+    ap.add_argument("--db", default="iris.db")
+    args = ap.parse_args()
+    try:
+        users = load_sections("STORAGE", "CONVERSATION STORE", "USER STORE")["UserStore"](args.db)
+    except ValueError as e:
+        sys.exit(f"users.json here is unreadable, fix or move it first: {e}")
+    if args.action == "export":
+        print(f"exported {users.export_json(args.path)} accounts to {args.path}")
+    else:
+        print(f"imported {users.import_json(args.path, replace=args.replace)} accounts from {args.path}")
+
+if __name__ == "__main__":
+    main()